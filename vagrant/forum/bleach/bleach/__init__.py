@@ -8,18 +8,29 @@ except ImportError:
     class NullHandler(logging.Handler):
         def emit(self, record):
             pass
+from collections import deque
+import itertools
+import multiprocessing
+import pkgutil
 import re
+import threading
 
 import html5lib
+import six
 from html5lib.sanitizer import HTMLSanitizer
 from html5lib.serializer.htmlserializer import HTMLSerializer
+from html5lib.tokenizer import HTMLTokenizer
 
 from . import callbacks as linkify_callbacks
+from .cache import CleanCache
 from .encoding import force_unicode
-from .sanitizer import BleachSanitizer
+from .sanitizer import BleachSanitizer, LimitExceeded, limit_tokens
+from .serializer import serialize_etree
+from .streaming import ChunkReader, balance
 from .version import __version__, VERSION # flake8: noqa
 
-__all__ = ['clean', 'linkify']
+__all__ = ['CleanCache', 'Cleaner', 'LimitExceeded', 'clean', 'clean_many',
+           'is_clean', 'linkify']
 
 log = logging.getLogger(__name__)
 log.addHandler(NullHandler())
@@ -49,22 +60,55 @@ ALLOWED_STYLES = []
 
 ALLOWED_PROTOCOLS = ['http', 'https', 'mailto']
 
-TLDS = """ac ad ae aero af ag ai al am an ao aq ar arpa as asia at au aw ax az
-       ba bb bd be bf bg bh bi biz bj bm bn bo br bs bt bv bw by bz ca cat
-       cc cd cf cg ch ci ck cl cm cn co com coop cr cu cv cx cy cz de dj dk
-       dm do dz ec edu ee eg er es et eu fi fj fk fm fo fr ga gb gd ge gf gg
-       gh gi gl gm gn gov gp gq gr gs gt gu gw gy hk hm hn hr ht hu id ie il
-       im in info int io iq ir is it je jm jo jobs jp ke kg kh ki km kn kp
-       kr kw ky kz la lb lc li lk lr ls lt lu lv ly ma mc md me mg mh mil mk
-       ml mm mn mo mobi mp mq mr ms mt mu museum mv mw mx my mz na name nc ne
-       net nf ng ni nl no np nr nu nz om org pa pe pf pg ph pk pl pm pn post
-       pr pro ps pt pw py qa re ro rs ru rw sa sb sc sd se sg sh si sj sk sl
-       sm sn so sr ss st su sv sx sy sz tc td tel tf tg th tj tk tl tm tn to
-       tp tr travel tt tv tw tz ua ug uk us uy uz va vc ve vg vi vn vu wf ws
-       xn xxx ye yt yu za zm zw""".split()
-
-# Make sure that .com doesn't get matched by .co first
-TLDS.reverse()
+
+def load_tlds(data=None):
+    """Return the list of top-level domains in a TLD data file
+
+    :arg data: the contents of the file; defaults to the ``tlds.txt``
+        file shipped with bleach
+
+    The file lists one domain per line. Blank lines and lines starting
+    with ``#`` are ignored.
+
+    """
+    if data is None:
+        data = pkgutil.get_data('bleach', 'tlds.txt')
+    data = force_unicode(data)
+    return [line.strip().lower() for line in data.splitlines()
+            if line.strip() and not line.lstrip().startswith('#')]
+
+
+def trie_pattern(words):
+    """Return a regular expression alternation matching any of words
+
+    The words are put in a trie, so the pattern branches on one character
+    at a time instead of trying every word in turn, and where one word is
+    a prefix of another the longer one is tried first.
+
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(node[char])
+                    for char in sorted(node) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and len(node) == 1:
+            return branches[0]
+        group = '(?:' + '|'.join(branches) + ')'
+        if '' in node:
+            group += '?'
+        return group
+
+    return pattern(trie)
+
+
+TLDS = load_tlds()
 
 PROTOCOLS = HTMLSanitizer.acceptable_protocols
 
@@ -75,7 +119,7 @@ url_re = re.compile(
     (?:[/?][^\s\{{\}}\|\\\^\[\]`<>"]*)?
         # /path/zz (excluding "unsafe" chars from RFC 1738,
         # except for # and ~, which happen in practice)
-    """.format('|'.join(PROTOCOLS), '|'.join(TLDS)),
+    """.format(trie_pattern(PROTOCOLS), trie_pattern(TLDS)),
     re.IGNORECASE | re.VERBOSE | re.UNICODE)
 
 proto_re = re.compile(r'^[\w-]+:/{0,3}', re.IGNORECASE)
@@ -92,6 +136,18 @@ email_re = re.compile(
     """,
     re.IGNORECASE | re.MULTILINE | re.VERBOSE)
 
+# Text without any of these characters parses to a single text node with
+# exactly the same characters: no tags, comments or entities, and nothing
+# the parser would normalize (\r), drop (\0) or replace (lone surrogates).
+markup_re = re.compile('[<&\r\x00\ud800-\udfff]')
+
+# Tokenizers that pass plain text through unchanged.
+PLAIN_TEXT_TOKENIZERS = (HTMLSanitizer, HTMLTokenizer)
+
+# Default nesting limit and output chunk size of Cleaner.iter_clean().
+STREAM_MAX_DEPTH = 512
+STREAM_CHUNK_SIZE = 8192
+
 NODE_TEXT = 4  # The numeric ID of a text node in simpletree.
 
 ETREE_TAG = lambda x: "".join(['{http://www.w3.org/1999/xhtml}', x])
@@ -103,7 +159,8 @@ DEFAULT_CALLBACKS = [linkify_callbacks.nofollow]
 
 def clean(text, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
           styles=ALLOWED_STYLES, protocols=ALLOWED_PROTOCOLS, strip=False,
-          strip_comments=True):
+          strip_comments=True, cache=None, max_length=None, max_depth=None,
+          max_tokens=None):
     """Clean an HTML fragment and return it
 
     :arg text: the text to clean
@@ -117,72 +174,480 @@ def clean(text, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
         to ``bleach.ALLOWED_PROTOCOLS``
     :arg strip: whether or not to strip disallowed elements
     :arg strip_comments: whether or not to strip HTML comments
+    :arg cache: a :class:`CleanCache` to look the result up in and store
+        it in
+    :arg max_length: the most characters ``text`` may have
+    :arg max_depth: the deepest allowed elements may be nested
+    :arg max_tokens: the most tags, comments and runs of text ``text``
+        may be made of
+
+    If ``text`` goes over one of the limits, :class:`LimitExceeded` is
+    raised as soon as that is found, without reading the rest of it. They
+    all default to no limit.
+
+    To clean many fragments with the same arguments, create a
+    :class:`Cleaner` once and call its ``clean()`` method instead.
 
     """
     if not text:
         return ''
 
     text = force_unicode(text)
+    _check_length(text, max_length)
+    if not markup_re.search(text):
+        return _escape_text(text)
+
+    return Cleaner(tags=tags, attributes=attributes, styles=styles,
+                   protocols=protocols, strip=strip,
+                   strip_comments=strip_comments, cache=cache,
+                   max_depth=max_depth, max_tokens=max_tokens).clean(text)
+
+
+class Cleaner(object):
+    """Clean HTML fragments with a fixed whitelist
+
+    A ``Cleaner`` takes the same whitelist arguments as :func:`clean`, but
+    does all the work that only depends on them once: it turns the
+    whitelists into lookup sets and builds the sanitizing tokenizer class.
+    Each thread that uses it gets its own parser, which is reused for
+    every fragment, so ``Cleaner.clean()`` is safe to call from several
+    threads at once.
+
+    The whitelists are copied when the ``Cleaner`` is created; changing
+    them afterwards has no effect on it.
+
+    With ``linkify=True``, ``clean()`` also does what :func:`linkify` does
+    to the cleaned fragment, with the ``callbacks``, ``skip_pre`` and
+    ``parse_email`` arguments given here, in the same pass: the fragment
+    is parsed and serialized once instead of twice. The result is the
+    same as ``linkify(clean(text))``.
+
+    ``sort_attributes`` controls whether attributes are put in
+    alphabetical order in the output; otherwise they are left in the
+    order the parser gives them. With ``fast_serializer=True`` the
+    output is written straight from the parsed tree rather than through
+    html5lib's tree walker and serializer, which is several times faster
+    and gives the same output.
+
+    Given a :class:`CleanCache` as ``cache``, ``clean()`` remembers its
+    results there and returns them straight away for inputs it has
+    cleaned before.
+
+    ``max_length``, ``max_depth`` and ``max_tokens`` limit the fragments
+    ``clean()`` accepts, as for :func:`clean`. ``iter_clean()`` only
+    checks ``max_tokens``.
+
+    """
 
-    class s(BleachSanitizer):
-        allowed_elements = tags
-        allowed_attributes = attributes
-        allowed_css_properties = styles
-        allowed_protocols = protocols
-        strip_disallowed_elements = strip
-        strip_html_comments = strip_comments
+    def __init__(self, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES,
+                 styles=ALLOWED_STYLES, protocols=ALLOWED_PROTOCOLS,
+                 strip=False, strip_comments=True, linkify=False,
+                 callbacks=DEFAULT_CALLBACKS, skip_pre=False,
+                 parse_email=False, sort_attributes=True,
+                 fast_serializer=False, cache=None, max_length=None,
+                 max_depth=None, max_tokens=None):
+        self.tags = frozenset(tags)
+        if isinstance(attributes, dict) or callable(attributes):
+            self.attributes = attributes
+        else:
+            self.attributes = frozenset(attributes)
+        self.styles = frozenset(styles)
+        self.protocols = frozenset(protocols)
+        self.strip = strip
+        self.strip_comments = strip_comments
+        self.linkify = linkify
+        self.callbacks = list(callbacks)
+        self.skip_pre = skip_pre
+        self.parse_email = parse_email
+        self.sort_attributes = sort_attributes
+        self.fast_serializer = fast_serializer
+        self.cache = cache
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.max_tokens = max_tokens
+        if cache is not None:
+            self.fingerprint = self._fingerprint()
+
+        class s(BleachSanitizer):
+            allowed_elements = self.tags
+            allowed_attributes = self.attributes
+            allowed_css_properties = self.styles
+            allowed_protocols = self.protocols
+            strip_disallowed_elements = self.strip
+            strip_html_comments = self.strip_comments
+            max_depth = self.max_depth
+            max_tokens = self.max_tokens
+
+        self.sanitizer = s
+        self._local = threading.local()
+
+    def _fingerprint(self):
+        """Return a hashable summary of everything that affects output."""
+        attributes = self.attributes
+        if isinstance(attributes, dict):
+            attributes = frozenset(
+                (tag, allowed if callable(allowed) else frozenset(allowed))
+                for tag, allowed in attributes.items())
+        return (self.tags, attributes, self.styles, self.protocols,
+                self.strip, self.strip_comments, self.linkify,
+                tuple(self.callbacks), self.skip_pre, self.parse_email,
+                self.sort_attributes, self.max_depth, self.max_tokens)
+
+    def _parser(self):
+        """Return this thread's parser, creating it on first use."""
+        parser = getattr(self._local, 'parser', None)
+        if parser is None:
+            parser = self._local.parser = html5lib.HTMLParser(
+                tokenizer=self.sanitizer)
+        return parser
+
+    def _linkify_parser(self):
+        """Return this thread's parser for HTML that linkify adds."""
+        parser = getattr(self._local, 'linkify_parser', None)
+        if parser is None:
+            parser = self._local.linkify_parser = html5lib.HTMLParser(
+                tokenizer=HTMLSanitizer)
+        return parser
+
+    def clean(self, text):
+        """Clean an HTML fragment and return it
+
+        :arg text: the text to clean
 
-    parser = html5lib.HTMLParser(tokenizer=s)
+        """
+        if not text:
+            return ''
+
+        text = force_unicode(text)
+        _check_length(text, self.max_length)
+        if not markup_re.search(text) and not (
+                self.linkify and _has_links(text, self.parse_email)):
+            return _escape_text(text)
+
+        if self.cache is None:
+            return self._clean(text)
+        key = self.cache.key(self.fingerprint, text)
+        cleaned = self.cache.get(key)
+        if cleaned is None:
+            cleaned = self._clean(text)
+            self.cache.put(key, cleaned)
+        return cleaned
+
+    def _clean(self, text):
+        forest = self._parser().parseFragment(text)
+        if self.linkify:
+            _linkify_tree(forest, self._linkify_parser(), self.callbacks,
+                          self.skip_pre, self.parse_email)
+        return _render(forest, self.sort_attributes, self.fast_serializer)
+
+    def is_clean(self, text):
+        """Return whether an HTML fragment is already clean
+
+        :arg text: the text to check
+
+        It is clean if ``clean()`` would not escape, strip or change any
+        of its tags, attributes or comments. The tokens are checked as
+        they are read, stopping at the first one that would change,
+        without building a tree or serializing anything, so this is much
+        cheaper than comparing ``clean(text)`` with ``text``.
+
+        ``clean()`` can still write a clean fragment differently, for
+        example quoting attribute values, escaping ``<`` and ``&`` in
+        text or closing tags left open; those differences don't count.
+        It can't be used with ``linkify=True``, and ``max_depth`` is not
+        checked.
 
-    return _render(parser.parseFragment(text))
+        """
+        if self.linkify:
+            raise ValueError('is_clean() does not support linkify')
+        if not text:
+            return True
+
+        text = force_unicode(text)
+        _check_length(text, self.max_length)
+        if not markup_re.search(text):
+            return True
+        return self.sanitizer(text).is_clean()
+
+    def iter_clean(self, chunks, max_depth=STREAM_MAX_DEPTH):
+        """Clean an HTML fragment given in chunks, yielding the output
+
+        :arg chunks: an iterable of text (or UTF-8 bytes) chunks of the
+            fragment; it is read lazily
+        :arg max_depth: the deepest elements may be nested; start tags
+            below that are stripped, keeping their content
+
+        Unlike ``clean()``, this does not build a tree of the whole
+        fragment: tags are sanitized and serialized as they are read, and
+        output is yielded every few kilobytes, so memory use stays flat
+        however large the input is. Open tags are tracked on a stack to
+        keep the output balanced, but badly nested markup is not repaired
+        the way the HTML parser would, so the output can differ from
+        ``clean()`` for it. It can't be used with ``linkify=True``.
+
+        """
+        if self.linkify:
+            raise ValueError('iter_clean() does not support linkify')
+        tokenizer = self.sanitizer(ChunkReader(chunks))
+        serializer = HTMLSerializer(
+            **_serializer_options(self.sort_attributes))
+        buf = []
+        size = 0
+        for piece in serializer.serialize(balance(tokenizer, max_depth)):
+            buf.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+
+def clean_many(texts, workers=None, chunksize=100, **policy):
+    """Clean many HTML fragments in a pool of processes
+
+    Yields the cleaned fragments in the same order as ``texts``.
+
+    :arg texts: an iterable of texts to clean; it is read lazily
+    :arg workers: number of worker processes; defaults to the number of
+        CPUs. With 1, the texts are cleaned in this process.
+    :arg chunksize: number of texts sent to a worker at a time
+    :arg policy: the whitelist arguments :func:`clean` takes; they must
+        be picklable
+
+    Each worker creates a :class:`Cleaner` from ``policy`` once. At most
+    two chunks per worker are in flight at any time, so memory use does
+    not grow with the length of ``texts``.
+
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chunksize < 1:
+        raise ValueError('chunksize must be at least 1')
+
+    # Check the policy here; a worker that fails to start is just replaced.
+    cleaner = Cleaner(**policy)
+    texts = iter(texts)
+    chunks = iter(lambda: list(itertools.islice(texts, chunksize)), [])
+
+    if workers <= 1:
+        for chunk in chunks:
+            for text in chunk:
+                yield cleaner.clean(text)
+        return
+
+    pool = multiprocessing.Pool(workers, _init_worker, (policy,))
+    try:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(_clean_chunk, (chunk,)))
+            if len(pending) >= 2 * workers:
+                for text in pending.popleft().get():
+                    yield text
+        while pending:
+            for text in pending.popleft().get():
+                yield text
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+_worker_cleaner = None
+
+
+def is_clean(text, **policy):
+    """Return whether an HTML fragment is already clean
+
+    :arg text: the text to check
+    :arg policy: the whitelists and other arguments of :class:`Cleaner`
+
+    See :meth:`Cleaner.is_clean`. To check many fragments against the
+    same whitelists, create a :class:`Cleaner` once and call its
+    ``is_clean()`` method instead.
+
+    """
+    return Cleaner(**policy).is_clean(text)
+
+
+def _init_worker(policy):
+    """Create the Cleaner a clean_many() worker process uses."""
+    global _worker_cleaner
+    _worker_cleaner = Cleaner(**policy)
+
+
+def _clean_chunk(chunk):
+    return [_worker_cleaner.clean(text) for text in chunk]
 
 
 def linkify(text, callbacks=DEFAULT_CALLBACKS, skip_pre=False,
-            parse_email=False, tokenizer=HTMLSanitizer):
+            parse_email=False, tokenizer=HTMLSanitizer, max_length=None,
+            max_depth=None, max_tokens=None):
     """Convert URL-like strings in an HTML fragment to links.
 
     linkify() converts strings that look like URLs or domain names in a
     blob of text that may be an HTML fragment to links, while preserving
     (a) links already in the string, (b) urls found in attributes, and
     (c) email addresses.
+
+    ``max_length``, ``max_depth`` and ``max_tokens`` limit the fragments
+    it accepts, as for clean(), raising LimitExceeded.
     """
     text = force_unicode(text)
 
     if not text:
         return ''
 
+    _check_length(text, max_length)
+
+    if (tokenizer in PLAIN_TEXT_TOKENIZERS and not markup_re.search(text) and
+            not _has_links(text, parse_email)):
+        # No markup and nothing to turn into a link.
+        return _escape_text(text)
+
+    if max_depth is not None or max_tokens is not None:
+        tokenizer = _limited(tokenizer, max_depth, max_tokens)
     parser = html5lib.HTMLParser(tokenizer=tokenizer)
 
     forest = parser.parseFragment(text)
+    _linkify_tree(forest, parser, callbacks, skip_pre, parse_email)
+    return _render(forest)
+
+
+def _limited(tokenizer, max_depth, max_tokens):
+    """Return a subclass of tokenizer that enforces the limits."""
+    class Limited(tokenizer):
+        def __iter__(self):
+            return limit_tokens(tokenizer.__iter__(self), self.parser,
+                                max_depth, max_tokens)
+    return Limited
+
+
+def _check_length(text, max_length):
+    if max_length is not None and len(text) > max_length:
+        raise LimitExceeded('longer than %d characters' % max_length)
+
+
+def _has_links(text, parse_email):
+    """Return whether linkify() would find anything to link in text."""
+    return bool(url_re.search(text) or
+                (parse_email and email_re.search(text)))
+
+
+def _linkify_tree(forest, parser, callbacks, skip_pre, parse_email):
+    """Linkify the text in a parsed fragment, in place.
+
+    parser is used to parse any HTML that has to be put in the tree: the
+    text of links that callbacks change or remove.
+
+    """
     _seen = set([])
 
+    def insert_nodes(tree, new_nodes, index):
+        """Insert new_nodes into tree at position index."""
+        for n in new_nodes:
+            if n.tag == ETREE_TAG('a'):
+                _seen.add(n)
+        tree[index:index] = new_nodes
+
+    def append_text(tree, index, text):
+        """Add text to tree just before its child at position index."""
+        if index == 0:
+            tree.text = (tree.text or '') + text
+        else:
+            tree[index - 1].tail = (tree[index - 1].tail or '') + text
+
     def replace_nodes(tree, new_frag, node, index=0):
         """
         Doesn't really replace nodes, but inserts the nodes contained in
         new_frag into the treee at position index and returns the number
         of nodes inserted.
-        If node is passed in, it is removed from the tree
+        If node is passed in, it is removed from the tree, keeping its tail
         """
-        count = 0
         new_tree = parser.parseFragment(new_frag)
         # capture any non-tag text at the start of the fragment
         if new_tree.text:
-            if index == 0:
-                tree.text = tree.text or ''
-                tree.text += new_tree.text
-            else:
-                tree[index - 1].tail = tree[index - 1].tail or ''
-                tree[index - 1].tail += new_tree.text
+            append_text(tree, index, new_tree.text)
         # the put in the tagged elements into the old tree
-        for n in new_tree:
-            if n.tag == ETREE_TAG('a'):
-                _seen.add(n)
-            tree.insert(index + count, n)
-            count += 1
+        new_nodes = list(new_tree)
+        insert_nodes(tree, new_nodes, index)
         # if we got a node to remove...
         if node is not None:
+            if node.tail:
+                append_text(tree, index + len(new_nodes), node.tail)
             tree.remove(node)
-        return count
+        return len(new_nodes)
+
+    def set_inner(node, text):
+        """Set the content of node to the HTML fragment text."""
+        if not markup_re.search(text):
+            node.text = text
+            return
+        text = parser.parseFragment(text)
+        node.text = text.text
+        for n in text:
+            node.append(n)
+
+    def make_link(attrs, text, original):
+        """Build an <a> element for a link found in the text.
+
+        A callback may have set ``_text`` to markup; it is only parsed if
+        it was changed from the text the link was found in.
+
+        """
+        link = forest.makeelement(ETREE_TAG('a'), {})
+        for attr_key, attr_val in attrs.items():
+            link.set(attr_key, force_unicode(attr_val))
+        text = force_unicode(text)
+        if text == original:
+            link.text = text
+        else:
+            set_inner(link, text)
+        return link
+
+    def find_links(text, regex, repl):
+        """Split text into strings and the <a> elements repl makes from
+        the matches of regex, or return None if no links were made."""
+        pieces = []
+        pos = 0
+        for match in regex.finditer(text):
+            pieces.append(text[pos:match.start()])
+            pieces.extend(repl(match))
+            pos = match.end()
+        if all(isinstance(piece, six.string_types) for piece in pieces):
+            return None
+        pieces.append(text[pos:])
+        return pieces
+
+    def linkify_text(text):
+        """Return text as a leading string and a list of the nodes to
+        follow it, with emails and URLs made into links, or None if there
+        are no links in it."""
+        pieces = None
+        if parse_email:
+            pieces = find_links(text, email_re, email_repl)
+        if pieces is None:
+            pieces = [text]
+        linked = []
+        for piece in pieces:
+            if isinstance(piece, six.string_types):
+                linked.extend(find_links(piece, url_re, link_repl) or
+                              [piece])
+            else:
+                linked.append(piece)
+        if all(isinstance(piece, six.string_types) for piece in linked):
+            return None
+
+        lead = ''
+        new_nodes = []
+        for piece in linked:
+            if not isinstance(piece, six.string_types):
+                new_nodes.append(piece)
+            elif new_nodes:
+                new_nodes[-1].tail = (new_nodes[-1].tail or '') + piece
+            else:
+                lead += piece
+        return lead, new_nodes
 
     def strip_wrapping_parentheses(fragment):
         """Strips wrapping parentheses.
@@ -242,92 +707,73 @@ def linkify(text, callbacks=DEFAULT_CALLBACKS, skip_pre=False,
         return ''.join(out)
 
     def linkify_nodes(tree, parse_text=True):
-        children = len(tree)
-        current_child = -1
-        # start at -1 to process the parent first
-        while current_child < len(tree):
+        # Walk the tree with an explicit stack of [element, parse_text,
+        # next child] frames rather than recursing, so that deeply nested
+        # input can't exhaust the Python stack. Every child is visited once,
+        # apart from those put back in the tree when a link is dropped.
+        stack = [[tree, parse_text, -1]]
+        while stack:
+            frame = stack[-1]
+            tree, parse_text, current_child = frame
             if current_child < 0:
-                node = tree
-                if parse_text and node.text:
-                    new_txt = old_txt = node.text
-                    if parse_email:
-                        new_txt = re.sub(email_re, email_repl, node.text)
-                        if new_txt and new_txt != node.text:
-                            node.text = ''
-                            adj = replace_nodes(tree, new_txt, None, 0)
-                            children += adj
-                            current_child += adj
-                            linkify_nodes(tree, True)
-                            continue
-
-                    new_txt = re.sub(url_re, link_repl, new_txt)
-                    if new_txt != old_txt:
-                        node.text = ''
-                        adj = replace_nodes(tree, new_txt, None, 0)
-                        children += adj
-                        current_child += adj
-                        continue
-            else:
-                node = tree[current_child]
+                # start at -1 to process the parent's own text first
+                frame[2] = 0
+                if parse_text and tree.text:
+                    linked = linkify_text(tree.text)
+                    if linked is not None:
+                        tree.text, new_nodes = linked
+                        insert_nodes(tree, new_nodes, 0)
+                        # The new links are done; carry on after them.
+                        frame[2] = len(new_nodes)
+                continue
+            if current_child >= len(tree):
+                stack.pop()
+                continue
+
+            node = tree[current_child]
+            frame[2] = current_child + 1
 
             if parse_text and node.tail:
-                new_tail = old_tail = node.tail
-                if parse_email:
-                    new_tail = re.sub(email_re, email_repl, new_tail)
-                    if new_tail != node.tail:
-                        node.tail = ''
-                        adj = replace_nodes(tree, new_tail, None,
-                                            current_child + 1)
-                        # Insert the new nodes made from my tail into
-                        # the tree right after me. current_child+1
-                        children += adj
-                        continue
-
-                new_tail = re.sub(url_re, link_repl, new_tail)
-                if new_tail != old_tail:
-                    node.tail = ''
-                    adj = replace_nodes(tree, new_tail, None,
-                                        current_child + 1)
-                    children += adj
-
-            if node.tag == ETREE_TAG('a') and not (node in _seen):
-                if not node.get('href', None) is None:
-                    attrs = dict(node.items())
-
-                    _text = attrs['_text'] = _render_inner(node)
-
-                    attrs = apply_callbacks(attrs, False)
-
-                    if attrs is None:
-                        # <a> tag replaced by the text within it
-                        adj = replace_nodes(tree, _text, node,
-                                            current_child)
-                        current_child -= 1
-                        # pull back current_child by 1 to scan the
-                        # new nodes again.
-                    else:
-                        text = force_unicode(attrs.pop('_text'))
-                        for attr_key, attr_val in attrs.items():
-                            node.set(attr_key, attr_val)
-
-                        for n in reversed(list(node)):
-                            node.remove(n)
-                        text = parser.parseFragment(text)
-                        node.text = text.text
-                        for n in text:
-                            node.append(n)
-                        _seen.add(node)
-
-            elif current_child >= 0:
-                if node.tag == ETREE_TAG('pre') and skip_pre:
-                    linkify_nodes(node, False)
-                elif not (node in _seen):
-                    linkify_nodes(node, parse_text)
-
-            current_child += 1
+                linked = linkify_text(node.tail)
+                if linked is not None:
+                    node.tail, new_nodes = linked
+                    # Insert the new nodes made from my tail into the
+                    # tree right after me, and skip over them.
+                    insert_nodes(tree, new_nodes, current_child + 1)
+                    frame[2] += len(new_nodes)
+
+            if node.tag == ETREE_TAG('a'):
+                if node in _seen or node.get('href', None) is None:
+                    continue
+                attrs = dict(node.items())
+
+                _text = attrs['_text'] = _render_inner(node)
+
+                attrs = apply_callbacks(attrs, False)
+
+                if attrs is None:
+                    # <a> tag replaced by the text within it; scan the
+                    # new nodes again.
+                    replace_nodes(tree, _text, node, current_child)
+                    frame[2] = current_child
+                else:
+                    text = force_unicode(attrs.pop('_text'))
+                    for attr_key, attr_val in attrs.items():
+                        node.set(attr_key, attr_val)
+
+                    for n in reversed(list(node)):
+                        node.remove(n)
+                    node.text = None
+                    set_inner(node, text)
+                    _seen.add(node)
+
+            elif node.tag == ETREE_TAG('pre') and skip_pre:
+                stack.append([node, False, -1])
+            else:
+                stack.append([node, parse_text, -1])
 
     def email_repl(match):
-        addr = match.group(0).replace('"', '&quot;')
+        addr = match.group(0)
         link = {
             '_text': addr,
             'href': 'mailto:{0!s}'.format(addr),
@@ -335,15 +781,10 @@ def linkify(text, callbacks=DEFAULT_CALLBACKS, skip_pre=False,
         link = apply_callbacks(link, True)
 
         if link is None:
-            return addr
+            return [addr]
 
-        _href = link.pop('href')
         _text = link.pop('_text')
-
-        repl = '<a href="{0!s}" {1!s}>{2!s}</a>'
-        attr = '{0!s}="{1!s}"'
-        attribs = ' '.join(attr.format(k, v) for k, v in link.items())
-        return repl.format(_href, attribs, _text)
+        return [make_link(link, _text, addr)]
 
     def link_repl(match):
         url = match.group(0)
@@ -377,37 +818,52 @@ def linkify(text, callbacks=DEFAULT_CALLBACKS, skip_pre=False,
         link = apply_callbacks(link, True)
 
         if link is None:
-            return '(' * open_brackets + url + ')' * close_brackets
+            return [match.group(0)]
 
         _text = link.pop('_text')
-        _href = link.pop('href')
+        return ['(' * open_brackets, make_link(link, _text, url),
+                end + ')' * close_brackets]
 
-        repl = '{0!s}<a href="{1!s}" {2!s}>{3!s}</a>{4!s}{5!s}'
-        attr = '{0!s}="{1!s}"'
-        attribs = ' '.join(attr.format(k, v) for k, v in link.items())
+    linkify_nodes(forest)
 
-        return repl.format('(' * open_brackets,
-                           _href, attribs, _text, end,
-                           ')' * close_brackets)
 
-    try:
-        linkify_nodes(forest)
-    except RuntimeError as e:
-        # If we hit the max recursion depth, just return what we've got.
-        log.exception('Probable recursion error: {0!r}'.format(e))
-
-    return _render(forest)
+def _escape_text(text):
+    """Serialize plain text (see markup_re) the way _render would."""
+    return text.replace('>', '&gt;')
 
 
-def _render(tree):
+def _render(tree, sort_attributes=True, fast=False):
     """Try rendering as HTML, then XML, then give up."""
-    return force_unicode(_serialize(tree))
+    if fast:
+        return serialize_etree(tree, sort_attributes)
+    return force_unicode(_serialize(tree, sort_attributes))
+
+
+_TreeWalker = html5lib.treewalkers.getTreeWalker('etree')
+
+SERIALIZER_OPTIONS = {
+    'quote_attr_values': True,
+    'alphabetical_attributes': True,
+    'omit_optional_tags': False,
+}
+
+# HTMLSerializer keeps per-call state, so each thread gets its own (one
+# per sort_attributes setting).
+_serializers = threading.local()
+
+
+def _serializer_options(sort_attributes):
+    options = dict(SERIALIZER_OPTIONS)
+    options['alphabetical_attributes'] = sort_attributes
+    return options
 
 
-def _serialize(domtree):
-    walker = html5lib.treewalkers.getTreeWalker('etree')
-    stream = walker(domtree)
-    serializer = HTMLSerializer(quote_attr_values=True,
-                                alphabetical_attributes=True,
-                                omit_optional_tags=False)
-    return serializer.render(stream)
+def _serialize(domtree, sort_attributes=True):
+    serializers = getattr(_serializers, 'serializers', None)
+    if serializers is None:
+        serializers = _serializers.serializers = {}
+    serializer = serializers.get(sort_attributes)
+    if serializer is None:
+        serializer = serializers[sort_attributes] = HTMLSerializer(
+            **_serializer_options(sort_attributes))
+    return serializer.render(_TreeWalker(domtree))
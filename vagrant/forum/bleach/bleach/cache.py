@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+from collections import OrderedDict
+import hashlib
+import sys
+import threading
+
+import six
+
+
+# Lone surrogates are valid in input text, but only encode with this.
+ENCODE_ERRORS = 'surrogatepass' if six.PY3 else 'strict'
+
+
+class CleanCache(object):
+    """A bounded, thread-safe LRU cache of cleaned fragments
+
+    Pass one to :func:`bleach.clean` or :class:`bleach.Cleaner` as
+    ``cache`` to remember their output. Entries are keyed by a SHA-256
+    hash of the input and the cleaner's whitelist, so one cache can be
+    shared by cleaners with different whitelists.
+
+    :arg max_entries: the most results to keep
+    :arg max_bytes: the most memory, in bytes, the kept results may use
+
+    When either limit would be exceeded, the least recently used results
+    are dropped. A cache is pickled without its contents.
+
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._bytes = 0
+        self._hits = self._misses = self._evictions = 0
+
+    def __getstate__(self):
+        return {'max_entries': self.max_entries, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def key(fingerprint, text):
+        """Return the cache key for cleaning text with a whitelist."""
+        return fingerprint, hashlib.sha256(
+            text.encode('utf-8', ENCODE_ERRORS)).digest()
+
+    def get(self, key):
+        """Return the result stored under key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Store value under key, dropping old results to make room."""
+        size = sys.getsizeof(value) + sys.getsizeof(key[1])
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                dropped = self._entries.popitem(last=False)[1]
+                self._bytes -= dropped[1]
+                self._evictions += 1
+
+    def clear(self):
+        """Drop every stored result; the statistics are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Return a dictionary of hit, miss, eviction and size counters.
+
+        ``hit_ratio`` is the fraction of lookups that were hits, or 0.0
+        before the first lookup.
+
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_ratio': float(self._hits) / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
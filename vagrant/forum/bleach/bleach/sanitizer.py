@@ -6,16 +6,273 @@ from html5lib.constants import tokenTypes
 from html5lib.sanitizer import HTMLSanitizerMixin
 from html5lib.tokenizer import HTMLTokenizer
 
+from .cache import CleanCache
+from .streaming import CONTENT_STATES
+
 
 PROTOS = HTMLSanitizerMixin.acceptable_protocols
 PROTOS.remove('feed')
 
+TAG_TOKENS = (tokenTypes['StartTag'], tokenTypes['EndTag'],
+              tokenTypes['EmptyTag'])
+
+# Sanitized style attributes, keyed by (allowed properties, style).
+STYLE_CACHE = CleanCache(max_entries=1000, max_bytes=1024 * 1024)
+
+# Whether URI attribute values are allowed, keyed by (protocols, value).
+URI_CACHE = CleanCache(max_entries=10000, max_bytes=4 * 1024 * 1024)
+
+uri_strip_re = re.compile(r'[`\000-\040\177-\240\s]+')
+uri_scheme_re = re.compile(r'([a-z0-9][-+.a-z0-9]*):')
+svg_ref_re = re.compile(r'url\s*\(\s*[^#\s][^)]+?\)')
+local_href_re = re.compile(r'\s*[^#\s]')
+
+url_start_re = re.compile(r'url\s*\(\s*')
+url_run_re = re.compile(r'[^\s)]*')
+url_end_re = re.compile(r'\s*\)\s*')
+
+space_re = re.compile(r'\s*')
+declaration_re = re.compile(r'([-\w]+)\s*:\s*([^:;]*)')
+
+# A declaration passes the "gauntlet" if it can be split into these
+# pieces. The first pattern accepts the common case in one pass; the
+# others are only tried, one position at a time, when it fails.
+gauntlet_re = re.compile(r"""[-/:,#%.'"\sa-zA-Z0-9!]*"""
+                         r"""(?:\([\d,%.\s]+\)[-/:,#%.'"\sa-zA-Z0-9!]*)*\Z""")
+gauntlet_bad_re = re.compile(r"""[^-/:,#%.'"\s\w!()]""")
+gauntlet_char_re = re.compile(r"""[-/:,#%.'"\sa-zA-Z0-9!]""")
+gauntlet_piece_re = re.compile(r"""\w-\w|'[\s\w]+'|"[\s\w]+"|\([\d,%.\s]+\)""")
+
+
+class LimitExceeded(ValueError):
+    """A fragment is longer, more deeply nested or has more tokens than the
+    limits it is being cleaned with allow."""
+
+
+def limit_tokens(tokens, parser=None, max_depth=None, max_tokens=None):
+    """Yield tokens, raising LimitExceeded as soon as a limit is passed.
+
+    :arg tokens: the token stream of ``parser``'s tokenizer
+    :arg parser: the ``HTMLParser`` building a tree from the tokens; the
+        depth is only checked if it is given
+    :arg max_depth: the deepest elements may be nested in the tree
+    :arg max_tokens: the most tokens that may be read
+
+    The depth is that of the parser's open elements, checked as each
+    token is read, once the parser has handled the one before; so tags
+    the parser closes implicitly, like a ``<p>`` followed by another, do
+    not count.
+
+    """
+    check = max_depth is not None and parser is not None
+    count = 0
+    for token in tokens:
+        count += 1
+        if max_tokens is not None and count > max_tokens:
+            raise LimitExceeded('more than %d tokens' % max_tokens)
+        if check:
+            _check_depth(parser, max_depth)
+        yield token
+    if check:
+        _check_depth(parser, max_depth)
+
+
+def _check_depth(parser, max_depth):
+    # The fragment's root html element is always open.
+    if len(parser.tree.openElements) - 1 > max_depth:
+        raise LimitExceeded('nested deeper than %d elements' % max_depth)
+
+
+def compile_attributes(attributes):
+    """Compile an attribute whitelist into per-tag lookups.
+
+    ``attributes`` is a whitelist as taken by ``bleach.clean()``: a list of
+    attribute names allowed on every tag, a callable, or a dict mapping tag
+    names (or ``'*'`` for every tag) to lists or callables.
+
+    Returns a ``(per_tag, default)`` pair, where ``per_tag`` maps tag names
+    to their lookup and ``default`` is the lookup for every other tag. A
+    lookup is either a frozenset of allowed attribute names, with the
+    ``'*'`` names already merged in, or a callable taking the attribute
+    name and value.
+
+    """
+    if callable(attributes):
+        return {}, attributes
+    if not isinstance(attributes, dict):
+        return {}, frozenset(attributes)
+
+    wildcard = attributes.get('*', [])
+    if callable(wildcard):
+        default = wildcard
+    else:
+        default = frozenset(wildcard)
+
+    per_tag = {}
+    for tag, allowed in attributes.items():
+        if tag == '*':
+            continue
+        if callable(allowed):
+            per_tag[tag] = allowed
+        elif callable(wildcard):
+            per_tag[tag] = _either(frozenset(allowed), wildcard)
+        else:
+            per_tag[tag] = frozenset(allowed) | default
+    return per_tag, default
+
+
+def uri_allowed(value, protocols):
+    """Return whether a URI attribute value may be kept.
+
+    The value is unescaped, stripped of control characters, spaces and
+    replacement characters, and lowercased. It is allowed if it then has
+    no scheme, or its scheme is in ``protocols``.
+
+    """
+    value = uri_strip_re.sub('', unescape(value)).lower()
+    # Remove replacement characters from unescaped characters.
+    value = value.replace('\ufffd', '')
+    match = uri_scheme_re.match(value)
+    return match is None or match.group(1) in protocols
+
+
+def sanitize_style(style, properties):
+    """Sanitize the value of a style attribute.
+
+    ``url(...)`` values are replaced with a space. The rest must be a
+    list of ``property: value`` declarations separated by semicolons, and
+    each declaration must pass the same "gauntlet" of allowed characters,
+    quoted words and parenthesised numbers that bleach has always used;
+    otherwise the whole style is dropped and ``''`` returned.
+
+    Returns the declarations whose lowercased property is in
+    ``properties`` and whose value is not empty, as ``'prop: value;'``
+    joined by spaces.
+
+    Every step scans the style once, so hostile styles take time linear
+    in their length.
+
+    """
+    style = _strip_urls(style)
+    clean = []
+    pos = space_re.match(style).end()
+    while pos < len(style):
+        match = declaration_re.match(style, pos)
+        if match is None or not _gauntlet(match.group(0)):
+            return ''
+        pos = match.end()
+        if pos < len(style):
+            if style[pos] != ';':
+                return ''
+            pos = space_re.match(style, pos + 1).end()
+        prop, value = match.groups()
+        if value and prop.lower() in properties:
+            clean.append(prop + ': ' + value + ';')
+    return ' '.join(clean)
+
+
+def _strip_urls(style):
+    r"""Replace each ``url(...)`` in style, and any space after it, with ' '.
+
+    The same as ``re.sub(r'url\s*\(\s*[^\s)]+\s*\)\s*', ' ', style)``,
+    except that candidates sharing a run of argument characters reuse its
+    outcome instead of scanning it again.
+
+    """
+    if 'url' not in style:
+        return style
+    out = []
+    last = pos = 0
+    run_start = run_end = end = -1
+    while True:
+        match = url_start_re.search(style, pos)
+        if match is None:
+            break
+        start = match.end()
+        if not run_start <= start < run_end:
+            run_start = start
+            run_end = url_run_re.match(style, start).end()
+            close = url_end_re.match(style, run_end)
+            end = close.end() if close and run_end > start else -1
+        if end < 0:
+            pos = match.start() + 1
+            continue
+        out.append(style[last:match.start()])
+        out.append(' ')
+        last = pos = end
+    out.append(style[last:])
+    return ''.join(out)
+
+
+def _gauntlet(text):
+    """Return whether text can be split into gauntlet pieces."""
+    if gauntlet_re.match(text):
+        return True
+    if gauntlet_bad_re.search(text):
+        return False
+    reachable = [True] + [False] * len(text)
+    for pos in range(len(text)):
+        if not reachable[pos]:
+            continue
+        if gauntlet_char_re.match(text, pos):
+            reachable[pos + 1] = True
+        match = gauntlet_piece_re.match(text, pos)
+        if match:
+            reachable[match.end()] = True
+    return reachable[-1]
+
+
+def _either(names, test):
+    """Allow attributes in names, and any others that test allows."""
+    def allowed(name, value):
+        return name in names or test(name, value)
+    return allowed
+
 
 class BleachSanitizerMixin(HTMLSanitizerMixin):
     """Mixin to replace sanitize_token() and sanitize_css()."""
 
     allowed_svg_properties = []
 
+    def _attribute_lookups(self):
+        """Return compile_attributes(self.allowed_attributes).
+
+        The result is cached on the class the first time it is needed, and
+        recompiled only if ``allowed_attributes`` is replaced.
+
+        """
+        cls = type(self)
+        compiled = cls.__dict__.get('_compiled_attributes')
+        if compiled is None or compiled[0] is not self.allowed_attributes:
+            compiled = (self.allowed_attributes,
+                        compile_attributes(self.allowed_attributes))
+            cls._compiled_attributes = compiled
+        return compiled[1]
+
+    def _protocol_set(self):
+        """Return allowed_protocols as a frozenset.
+
+        Cached on the class like _attribute_lookups().
+
+        """
+        cls = type(self)
+        compiled = cls.__dict__.get('_compiled_protocols')
+        if compiled is None or compiled[0] is not self.allowed_protocols:
+            compiled = (self.allowed_protocols,
+                        frozenset(self.allowed_protocols))
+            cls._compiled_protocols = compiled
+        return compiled[1]
+
+    def _uri_allowed(self, value):
+        """Return uri_allowed(value, allowed_protocols), via URI_CACHE."""
+        protocols = self._protocol_set()
+        key = (protocols, value)
+        allowed = URI_CACHE.get(key)
+        if allowed is None:
+            allowed = uri_allowed(value, protocols)
+            URI_CACHE.put(key, allowed)
+        return allowed
+
     def sanitize_token(self, token):
         """Sanitize a token either by HTML-encoding or dropping.
 
@@ -27,47 +284,39 @@ class BleachSanitizerMixin(HTMLSanitizerMixin):
 
         Also gives the option to strip tags instead of encoding.
 
-        """
-        if (getattr(self, 'wildcard_attributes', None) is None and
-                isinstance(self.allowed_attributes, dict)):
-            self.wildcard_attributes = self.allowed_attributes.get('*', [])
+        The whitelist is compiled into a lookup per tag the first time it
+        is used; see compile_attributes().
+
+        Whether the protocol of a URI attribute is allowed is remembered
+        in URI_CACHE, so a link seen before is not unescaped and matched
+        again.
 
+        """
         if token['type'] in (tokenTypes['StartTag'], tokenTypes['EndTag'],
                              tokenTypes['EmptyTag']):
             if token['name'] in self.allowed_elements:
                 if 'data' in token:
-                    if isinstance(self.allowed_attributes, dict):
-                        allowed_attributes = self.allowed_attributes.get(
-                            token['name'], [])
-                        if not callable(allowed_attributes):
-                            allowed_attributes += self.wildcard_attributes
+                    per_tag, default = self._attribute_lookups()
+                    allowed_attributes = per_tag.get(token['name'], default)
+                    if callable(allowed_attributes):
+                        attrs = dict([(name, val) for name, val in
+                                      token['data'][::-1]
+                                      if allowed_attributes(name, val)])
                     else:
-                        allowed_attributes = self.allowed_attributes
-                    attrs = dict([(name, val) for name, val in
-                                  token['data'][::-1]
-                                  if (allowed_attributes(name, val)
-                                      if callable(allowed_attributes)
-                                      else name in allowed_attributes)])
+                        attrs = dict([(name, val) for name, val in
+                                      token['data'][::-1]
+                                      if name in allowed_attributes])
                     for attr in self.attr_val_is_uri:
-                        if attr not in attrs:
-                            continue
-                        val_unescaped = re.sub("[`\000-\040\177-\240\s]+", '',
-                                               unescape(attrs[attr])).lower()
-                        # Remove replacement characters from unescaped
-                        # characters.
-                        val_unescaped = val_unescaped.replace("\ufffd", "")
-                        if (re.match(r'^[a-z0-9][-+.a-z0-9]*:', val_unescaped)
-                            and (val_unescaped.split(':')[0] not in
-                                 self.allowed_protocols)):
+                        if (attr in attrs and
+                                not self._uri_allowed(attrs[attr])):
                             del attrs[attr]
                     for attr in self.svg_attr_val_allows_ref:
                         if attr in attrs:
-                            attrs[attr] = re.sub(r'url\s*\(\s*[^#\s][^)]+?\)',
-                                                 ' ',
-                                                 unescape(attrs[attr]))
+                            attrs[attr] = svg_ref_re.sub(
+                                ' ', unescape(attrs[attr]))
                     if (token['name'] in self.svg_allow_local_href and
                             'xlink:href' in attrs and
-                            re.search(r'^\s*[^#\s].*', attrs['xlink:href'])):
+                            local_href_re.match(attrs['xlink:href'])):
                         del attrs['xlink:href']
                     if 'style' in attrs:
                         attrs['style'] = self.sanitize_css(attrs['style'])
@@ -97,6 +346,24 @@ class BleachSanitizerMixin(HTMLSanitizerMixin):
         else:
             return token
 
+    def _css_properties(self):
+        """Return the allowed CSS and SVG properties as one frozenset.
+
+        Cached on the class like _attribute_lookups().
+
+        """
+        cls = type(self)
+        compiled = cls.__dict__.get('_compiled_css_properties')
+        if (compiled is None or
+                compiled[0] is not self.allowed_css_properties or
+                compiled[1] is not self.allowed_svg_properties):
+            compiled = (self.allowed_css_properties,
+                        self.allowed_svg_properties,
+                        frozenset(self.allowed_css_properties) |
+                        frozenset(self.allowed_svg_properties))
+            cls._compiled_css_properties = compiled
+        return compiled[2]
+
     def sanitize_css(self, style):
         """HTMLSanitizerMixin.sanitize_css replacement.
 
@@ -104,36 +371,24 @@ class BleachSanitizerMixin(HTMLSanitizerMixin):
         border-*, margin-*, and padding-*. We only whitelist what's in
         the whitelist.
 
-        """
-        # disallow urls
-        style = re.compile('url\s*\(\s*[^\s)]+?\s*\)\s*').sub(' ', style)
-
-        # gauntlet
-        # TODO: Make sure this does what it's meant to - I *think* it wants to
-        # validate style attribute contents.
-        parts = style.split(';')
-        gauntlet = re.compile("""^([-/:,#%.'"\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'"""
-                              """\s*|"[\s\w]+"|\([\d,%\.\s]+\))*$""")
-        for part in parts:
-            if not gauntlet.match(part):
-                return ''
-
-        if not re.match("^\s*([-\w]+\s*:[^:;]*(;\s*|$))*$", style):
-            return ''
-
-        clean = []
-        for prop, value in re.findall('([-\w]+)\s*:\s*([^:;]*)', style):
-            if not value:
-                continue
-            if prop.lower() in self.allowed_css_properties:
-                clean.append(prop + ': ' + value + ';')
-            elif prop.lower() in self.allowed_svg_properties:
-                clean.append(prop + ': ' + value + ';')
+        Results are kept in STYLE_CACHE, since the same inline styles
+        turn up over and over; see sanitize_style() for the rules.
 
-        return ' '.join(clean)
+        """
+        properties = self._css_properties()
+        key = (properties, style)
+        clean = STYLE_CACHE.get(key)
+        if clean is None:
+            clean = sanitize_style(style, properties)
+            STYLE_CACHE.put(key, clean)
+        return clean
 
 
 class BleachSanitizer(HTMLTokenizer, BleachSanitizerMixin):
+    # Limits for LimitExceeded; see limit_tokens().
+    max_depth = None
+    max_tokens = None
+
     def __init__(self, stream, encoding=None, parseMeta=True, useChardet=True,
                  lowercaseElementName=True, lowercaseAttrName=True, **kwargs):
         HTMLTokenizer.__init__(self, stream, encoding, parseMeta, useChardet,
@@ -141,7 +396,44 @@ class BleachSanitizer(HTMLTokenizer, BleachSanitizerMixin):
                                **kwargs)
 
     def __iter__(self):
-        for token in HTMLTokenizer.__iter__(self):
+        tokens = HTMLTokenizer.__iter__(self)
+        if self.max_depth is not None or self.max_tokens is not None:
+            # Tokens sanitize_token() drops count towards max_tokens too.
+            tokens = limit_tokens(tokens, self.parser, self.max_depth,
+                                  self.max_tokens)
+        for token in tokens:
             token = self.sanitize_token(token)
             if token:
                 yield token
+
+    def is_clean(self):
+        """Return whether sanitize_token() would leave every token alone.
+
+        Reads tokens only until the first one sanitize_token() would drop
+        or change: a tag it would escape or strip, an attribute it would
+        remove or rewrite, or a comment it would strip. Nothing is
+        serialized and no tree is built; as in streaming.balance(), the
+        tokenizer is switched into the state the parser would use inside
+        allowed elements like ``<textarea>``. ``max_tokens`` is checked,
+        ``max_depth`` is not.
+
+        """
+        tokens = HTMLTokenizer.__iter__(self)
+        if self.max_tokens is not None:
+            tokens = limit_tokens(tokens, max_tokens=self.max_tokens)
+        for token in tokens:
+            type = token['type']
+            if type in TAG_TOKENS:
+                name = token['name']
+                attrs = sorted(tuple(attr) for attr in token['data'])
+                token = self.sanitize_token(token)
+                if (token is None or token['type'] != type or
+                        sorted(token['data']) != attrs):
+                    return False
+                state = CONTENT_STATES.get(name)
+                if state is not None and type == tokenTypes['StartTag']:
+                    self.state = getattr(self, state)
+            elif type == tokenTypes['Comment']:
+                if self.sanitize_token(token) is None:
+                    return False
+        return True
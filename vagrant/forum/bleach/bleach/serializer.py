@@ -0,0 +1,106 @@
+from __future__ import unicode_literals
+import re
+
+from html5lib.constants import booleanAttributes, rcdataElements, voidElements
+from html5lib.utils import default_etree
+
+
+COMMENT = default_etree.Comment('').tag
+
+FRAGMENT_TAGS = ('DOCUMENT_ROOT', 'DOCUMENT_FRAGMENT')
+
+tag_re = re.compile('{([^}]*)}(.*)')
+
+_TEXT, _END = 0, 1
+
+
+def serialize_etree(tree, sort_attributes=True):
+    """Serialize an html5lib etree fragment without a tree walker.
+
+    The output is the same as html5lib's etree tree walker and
+    ``HTMLSerializer`` give with the options bleach uses
+    (``quote_attr_values=True``, ``omit_optional_tags=False`` and, if
+    ``sort_attributes`` is true, ``alphabetical_attributes=True``).
+
+    The tree is walked with an explicit stack, so it can be nested to any
+    depth. ``tree`` itself is serialized without its tail.
+
+    """
+    out = []
+    append = out.append
+    in_cdata = False
+    todo = [tree]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, tuple):
+            kind, data = node
+            if kind == _TEXT:
+                if in_cdata:
+                    append(data)
+                else:
+                    append(data.replace('&', '&amp;').replace('<', '&lt;')
+                           .replace('>', '&gt;'))
+            else:
+                if data in rcdataElements:
+                    in_cdata = False
+                append('</')
+                append(data)
+                append('>')
+            continue
+
+        tag = node.tag
+        if tag == COMMENT:
+            append('<!--%s-->' % node.text)
+            continue
+
+        if tag not in FRAGMENT_TAGS:
+            match = tag_re.match(tag)
+            name = match.group(2) if match else tag
+            append('<')
+            append(name)
+            if name in rcdataElements:
+                in_cdata = True
+            if node.attrib:
+                _serialize_attributes(append, name, node.attrib,
+                                      sort_attributes)
+            append('>')
+            if name in voidElements:
+                continue
+            todo.append((_END, name))
+
+        for child in reversed(node):
+            if child.tail:
+                todo.append((_TEXT, child.tail))
+            todo.append(child)
+        if node.text:
+            todo.append((_TEXT, node.text))
+
+    return ''.join(out)
+
+
+def _serialize_attributes(append, name, attrib, sort_attributes):
+    attrs = []
+    for key, value in attrib.items():
+        match = tag_re.match(key)
+        if match:
+            attrs.append((match.group(1), match.group(2), value))
+        else:
+            attrs.append(('', key, value))
+    if sort_attributes:
+        attrs.sort(key=lambda attr: attr[:2])
+
+    boolean = booleanAttributes.get(name, ())
+    for namespace, key, value in attrs:
+        append(' ')
+        append(key)
+        if key in boolean or key in booleanAttributes['']:
+            continue
+        value = value.replace('&', '&amp;')
+        if '"' in value and "'" not in value:
+            append("='")
+            append(value)
+            append("'")
+        else:
+            append('="')
+            append(value.replace('"', '&quot;'))
+            append('"')
@@ -0,0 +1,101 @@
+from __future__ import unicode_literals
+import codecs
+
+import six
+from html5lib.constants import tokenTypes, voidElements
+
+
+# Elements whose content the HTML parser tokenizes differently, and the
+# tokenizer state it switches to after their start tag.
+CONTENT_STATES = {
+    'title': 'rcdataState',
+    'textarea': 'rcdataState',
+    'style': 'rawtextState',
+    'xmp': 'rawtextState',
+    'iframe': 'rawtextState',
+    'noembed': 'rawtextState',
+    'noframes': 'rawtextState',
+    'noscript': 'rawtextState',
+    'script': 'scriptDataState',
+    'plaintext': 'plaintextState',
+}
+
+
+class ChunkReader(object):
+    """A file-like object reading text from an iterable of chunks.
+
+    Chunks may be text or UTF-8 encoded bytes. Only as much of the
+    iterable is consumed as ``read()`` needs.
+
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.buffer += self.decoder.decode(b'', True)
+                break
+            if isinstance(chunk, six.binary_type):
+                chunk = self.decoder.decode(chunk)
+            self.buffer += chunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def balance(tokenizer, max_depth):
+    """Turn sanitized tokenizer tokens into balanced tree walker tokens.
+
+    Keeps a stack of the open elements: an end tag closes its element and
+    any still open inside it, end tags for elements that are not open are
+    dropped, and everything still open is closed at the end. Start tags
+    nested deeper than ``max_depth`` are dropped, keeping their content,
+    so the stack never grows past it.
+
+    This is much simpler than the tree construction an HTML parser does:
+    well-formed markup comes out the same as from ``bleach.clean()``, but
+    badly nested markup may be fixed up differently.
+
+    """
+    stack = []
+    for token in tokenizer:
+        type = token['type']
+        if type in (tokenTypes['Characters'], tokenTypes['SpaceCharacters']):
+            # The parser drops NUL characters in text.
+            if token['data'] != '\x00':
+                yield {'type': 'Characters', 'data': token['data']}
+        elif type in (tokenTypes['StartTag'], tokenTypes['EmptyTag']):
+            name = token['name']
+            void = name in voidElements
+            if not void and len(stack) >= max_depth:
+                continue
+            state = CONTENT_STATES.get(name)
+            if state is not None:
+                tokenizer.state = getattr(tokenizer, state)
+            data = {}
+            for attr, value in token['data'][::-1]:
+                data[(None, attr)] = value
+            yield {'type': 'EmptyTag' if void else 'StartTag',
+                   'name': name, 'namespace': None, 'data': data}
+            if not void:
+                stack.append(name)
+        elif type == tokenTypes['EndTag']:
+            name = token['name']
+            if name not in stack:
+                continue
+            while True:
+                open_name = stack.pop()
+                yield {'type': 'EndTag', 'name': open_name,
+                       'namespace': None}
+                if open_name == name:
+                    break
+        elif type == tokenTypes['Comment']:
+            yield {'type': 'Comment', 'data': token['data']}
+    while stack:
+        yield {'type': 'EndTag', 'name': stack.pop(), 'namespace': None}
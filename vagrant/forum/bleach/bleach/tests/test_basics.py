@@ -1,6 +1,8 @@
+import threading
+
 import six
 import html5lib
-from nose.tools import eq_
+from nose.tools import assert_raises, eq_
 
 import bleach
 from bleach.tests.tools import in_
@@ -205,3 +207,97 @@ def test_user_defined_protocols_invalid():
     invalid_href = '<a href="http://xx.com">invalid href</a>'
     cleaned_href = '<a>invalid href</a>'
     eq_(cleaned_href, bleach.clean(invalid_href, protocols=['my_protocol']))
+
+
+def test_protocol_decisions_per_policy():
+    href = '<a href="ftp://xx.com">ftp</a>'
+    for i in range(2):
+        eq_('<a>ftp</a>', bleach.clean(href))
+        eq_(href, bleach.clean(href, protocols=['ftp']))
+        eq_('<a>ftp</a>', bleach.clean('<a href="FTP&#58;//xx.com">ftp</a>'))
+
+
+def test_cleaner_matches_clean():
+    TAGS = ['p', 'a']
+    ATTRS = {'a': ['href']}
+    cleaner = bleach.Cleaner(tags=TAGS, attributes=ATTRS, strip=True)
+    for dirty in ('<p><a href="http://xx.com" title="t">x</a></p>',
+                  '<p>an <em>unclosed <b>mess',
+                  '<script>safe()</script>'):
+        eq_(bleach.clean(dirty, tags=TAGS, attributes=ATTRS, strip=True),
+            cleaner.clean(dirty))
+
+
+def test_cleaner_reuse():
+    cleaner = bleach.Cleaner()
+    eq_('', cleaner.clean(''))
+    eq_('a <em>fixed tag</em>', cleaner.clean('a <em>fixed tag'))
+    eq_('a &lt;script&gt;safe()&lt;/script&gt; test',
+        cleaner.clean('a <script>safe()</script> test'))
+    eq_('a <em>fixed tag</em>', cleaner.clean('a <em>fixed tag'))
+
+
+def test_cleaner_copies_whitelists():
+    tags = ['b']
+    cleaner = bleach.Cleaner(tags=tags)
+    tags.append('i')
+    eq_('<b>x</b>&lt;i&gt;y&lt;/i&gt;', cleaner.clean('<b>x</b><i>y</i>'))
+
+
+def test_cleaner_threads():
+    cleaner = bleach.Cleaner()
+    dirty = 'an <em>allowed</em> and <span>escaped</span> tag %d'
+    results = {}
+
+    def work(n):
+        results[n] = [cleaner.clean(dirty % i) for i in range(50)]
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    expected = [bleach.clean(dirty % i) for i in range(50)]
+    for n in range(4):
+        eq_(expected, results[n])
+
+
+def test_wildcard_attributes_not_modified():
+    ATTR = {
+        '*': ['id'],
+        'img': ['src'],
+    }
+    TAG = ['img']
+    for i in range(3):
+        eq_('<img id="bar">',
+            bleach.clean('<img id="bar" alt="x">', tags=TAG, attributes=ATTR))
+    eq_({'*': ['id'], 'img': ['src']}, ATTR)
+
+
+def test_callable_wildcard_attributes():
+    ATTR = {
+        '*': lambda name, value: name.startswith('data-'),
+        'img': ['src'],
+    }
+    TAG = ['img', 'em']
+    eq_('<em data-x="1">x</em>',
+        bleach.clean('<em data-x="1" id="y">x</em>', tags=TAG,
+                     attributes=ATTR))
+    in_(('<img data-y="2" src="foo">', '<img src="foo" data-y="2">'),
+        bleach.clean('<img data-y="2" src="foo" alt="z">', tags=TAG,
+                     attributes=ATTR))
+
+
+def test_clean_many():
+    dirty = ['an <em>allowed</em> tag %d' % i for i in range(25)]
+    dirty += ['a <script>safe()</script> test', '', 'plain text']
+    for workers in (1, 2):
+        eq_([bleach.clean(s, tags=['em']) for s in dirty],
+            list(bleach.clean_many(iter(dirty), workers=workers,
+                                   chunksize=3, tags=['em'])))
+
+
+def test_clean_many_bad_policy():
+    assert_raises(TypeError, next,
+                  bleach.clean_many(['x'], workers=2, tag=['em']))
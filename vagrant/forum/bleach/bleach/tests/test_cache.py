@@ -0,0 +1,82 @@
+import pickle
+
+from nose.tools import eq_
+
+import bleach
+
+
+def test_hit():
+    cache = bleach.CleanCache()
+    cleaner = bleach.Cleaner(cache=cache)
+    dirty = 'a <script>safe()</script> test'
+    eq_(bleach.clean(dirty), cleaner.clean(dirty))
+    eq_(bleach.clean(dirty), cleaner.clean(dirty))
+    stats = cache.stats()
+    eq_((1, 1, 0.5, 1), (stats['hits'], stats['misses'], stats['hit_ratio'],
+                         stats['entries']))
+
+
+def test_plain_text_not_cached():
+    cache = bleach.CleanCache()
+    eq_('plain text', bleach.clean('plain text', cache=cache))
+    eq_(0, cache.stats()['entries'])
+
+
+def test_policies_kept_apart():
+    cache = bleach.CleanCache()
+    dirty = '<em>em</em> and <b>b</b>'
+    eq_('<em>em</em> and &lt;b&gt;b&lt;/b&gt;',
+        bleach.clean(dirty, tags=['em'], cache=cache))
+    eq_('em and <b>b</b>',
+        bleach.clean(dirty, tags=['b'], strip=True, cache=cache))
+    eq_('<em>em</em> and &lt;b&gt;b&lt;/b&gt;',
+        bleach.clean(dirty, tags=['em'], cache=cache))
+    eq_(1, cache.stats()['hits'])
+    eq_(2, cache.stats()['entries'])
+
+
+def test_attribute_policies_kept_apart():
+    cache = bleach.CleanCache()
+    dirty = '<a href="http://x.com" title="t">x</a>'
+    eq_('<a href="http://x.com">x</a>',
+        bleach.Cleaner(attributes={'a': ['href']}, cache=cache).clean(dirty))
+    eq_('<a title="t">x</a>',
+        bleach.Cleaner(attributes={'a': ['title']}, cache=cache).clean(dirty))
+
+
+def test_lru_entries():
+    cache = bleach.CleanCache(max_entries=2)
+    cleaner = bleach.Cleaner(cache=cache)
+    for dirty in ('<b>1</b>', '<b>2</b>', '<b>1</b>', '<b>3</b>', '<b>1</b>'):
+        cleaner.clean(dirty)
+    stats = cache.stats()
+    eq_((2, 3, 1, 2), (stats['hits'], stats['misses'], stats['evictions'],
+                       stats['entries']))
+
+
+def test_lru_bytes():
+    cache = bleach.CleanCache(max_bytes=1000)
+    cleaner = bleach.Cleaner(cache=cache)
+    for i in range(20):
+        cleaner.clean('<b>%s</b>' % ('x' * 100 + str(i)))
+    stats = cache.stats()
+    assert stats['bytes'] <= 1000
+    assert 0 < stats['entries'] < 20
+    cleaner.clean('<b>%s</b>' % ('x' * 2000))
+    assert cache.stats()['bytes'] <= 1000
+
+
+def test_pickle():
+    cache = bleach.CleanCache(max_entries=5, max_bytes=500)
+    bleach.clean('<b>x</b>', cache=cache)
+    copy = pickle.loads(pickle.dumps(cache))
+    eq_((5, 500, 0), (copy.max_entries, copy.max_bytes,
+                      copy.stats()['entries']))
+
+
+def test_clear():
+    cache = bleach.CleanCache()
+    bleach.clean('<b>x</b>', cache=cache)
+    cache.clear()
+    eq_(0, cache.stats()['entries'])
+    eq_('<b>x</b>', bleach.clean('<b>x</b>', cache=cache))
@@ -1,8 +1,12 @@
+from __future__ import unicode_literals
 from functools import partial
+import random
+import re
 
 from nose.tools import eq_
 
 from bleach import clean
+from bleach.sanitizer import STYLE_CACHE, sanitize_style
 
 
 clean = partial(clean, tags=['p'], attributes=['style'])
@@ -92,3 +96,55 @@ def test_style_hang():
 
     result = clean(html, styles=styles)
     eq_(expected, result)
+
+
+def reference_css(style, properties):
+    """The regex-based sanitize_css that sanitize_style() replaced."""
+    style = re.sub(r'url\s*\(\s*[^\s)]+?\s*\)\s*', ' ', style)
+    gauntlet = re.compile(r"""^([-/:,#%.'"\sa-zA-Z0-9!]|\w-\w|'[\s\w]+'"""
+                          r"""\s*|"[\s\w]+"|\([\d,%\.\s]+\))*$""")
+    for part in style.split(';'):
+        if not gauntlet.match(part):
+            return ''
+    if not re.match(r'^\s*([-\w]+\s*:[^:;]*(;\s*|$))*$', style):
+        return ''
+    return ' '.join(prop + ': ' + value + ';' for prop, value in
+                    re.findall(r'([-\w]+)\s*:\s*([^:;]*)', style)
+                    if value and prop.lower() in properties)
+
+
+def test_matches_reference():
+    pieces = ['color', 'Color', 'font-family', '_x', 'a_b', 'x-_', ':', ';',
+              ' ', '\n', 'red', '1px', "'", '"', "'Arial'", '"a b"', "'a_b'",
+              '(', ')', '(1,2%)', '(a)', 'url(', 'url(x)', 'url( x )', '-',
+              '_', '\xe9', '\xa0', '*', '!important', ',', '#', '/', '%']
+    properties = frozenset(['color', 'font-family', '_x'])
+    rnd = random.Random(2016)
+    for i in range(5000):
+        style = ''.join(rnd.choice(pieces) for j in range(rnd.randint(0, 10)))
+        eq_(reference_css(style, properties),
+            sanitize_style(style, properties))
+
+
+def test_hostile_styles():
+    """Styles that made the old regexes backtrack take linear time."""
+    properties = frozenset(['color'])
+    for style in ('color: ' + 'a-' * 10000 + '*',
+                  'color: ' + '_-' * 10000 + '_',
+                  'x: ' + "'_" * 10000,
+                  'url(' * 10000,
+                  'color: (1' * 10000):
+        eq_('', sanitize_style(style, properties))
+    eq_('color: red;',
+        sanitize_style('url(x) ' * 10000 + 'color: red', properties))
+
+
+def test_style_cache():
+    style = 'color: red; float: left; padding: 1em;'
+    html = '<p style="{0!s}">x</p>'.format(style)
+    clean(html, styles=['color'])
+    hits = STYLE_CACHE.stats()['hits']
+    eq_('<p style="color: red;">x</p>', clean(html, styles=['color']))
+    eq_(hits + 1, STYLE_CACHE.stats()['hits'])
+    eq_('<p style="color: red; float: left;">x</p>',
+        clean(html, styles=['color', 'float']))
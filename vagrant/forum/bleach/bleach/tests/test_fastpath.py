@@ -0,0 +1,78 @@
+"""Plain text skips parsing; make sure the output is the same either way."""
+from __future__ import unicode_literals
+
+import random
+
+from html5lib.sanitizer import HTMLSanitizer
+from nose.tools import eq_
+
+import bleach
+
+
+class SlowSanitizer(HTMLSanitizer):
+    """HTMLSanitizer, under a name linkify() has no fast path for."""
+
+
+CLEANER = bleach.Cleaner()
+
+EDGE_CASES = [
+    ' ',
+    '  leading and trailing  ',
+    '\n\nnewlines\n',
+    'tab\tand\x0cform feed',
+    'greater > than',
+    '>>>',
+    'a < b',
+    'a & b',
+    '&amp; &lt;',
+    'carriage\r\nreturn',
+    'nul\x00char',
+    '\ufeffbom',
+    'unicode \u2603 snowman',
+    'example.com',
+    'visit http://example.com.',
+    'mail me@example.com',
+    'no.tld.here',
+    'just some words, and a period.',
+    '3.14 > 2.71',
+]
+
+ALPHABET = ('abcXYZ 019\t\n.,;:/@-_()?!#%="\'>'
+            '\xa0\xe9\u2603\ufeff\U0001f600'
+            '<&\r\x00')
+
+
+def slow_clean(text):
+    text = bleach.force_unicode(text)
+    if not text:
+        return ''
+    return bleach._render(CLEANER._parser().parseFragment(text))
+
+
+def random_texts(count, seed=2016):
+    rnd = random.Random(seed)
+    for i in range(count):
+        # Mostly plain text, sometimes with a character that needs parsing.
+        alphabet = ALPHABET if i % 4 == 0 else ALPHABET[:-4]
+        yield ''.join(rnd.choice(alphabet)
+                      for j in range(rnd.randint(1, 40)))
+
+
+def test_clean_differential():
+    for text in EDGE_CASES + list(random_texts(500)):
+        eq_(slow_clean(text), bleach.clean(text))
+        eq_(slow_clean(text), CLEANER.clean(text))
+
+
+def test_linkify_differential():
+    for text in EDGE_CASES + list(random_texts(500)):
+        eq_(bleach.linkify(text, tokenizer=SlowSanitizer),
+            bleach.linkify(text))
+        eq_(bleach.linkify(text, tokenizer=SlowSanitizer, parse_email=True),
+            bleach.linkify(text, parse_email=True))
+
+
+def test_plain_text_escaping():
+    eq_('a &gt; b', bleach.clean('a > b'))
+    eq_('a &gt; b', bleach.linkify('a > b'))
+    eq_('plain', bleach.clean(b'plain'))
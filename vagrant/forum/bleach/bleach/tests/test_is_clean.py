@@ -0,0 +1,77 @@
+from __future__ import unicode_literals
+
+from nose.tools import assert_raises, eq_
+
+import bleach
+from bleach.tests.test_serializer import fragments
+
+
+def test_clean():
+    tests = (
+        '',
+        'plain text',
+        'a < b & c > d',
+        '<b>bold</b> and <em>em</em>',
+        '<a href="http://example.com" title="t">link</a>',
+        '<a title="t" href="/relative">link</a>',
+        '<b>unclosed',
+        '&lt;script&gt;escaped&lt;/script&gt;',
+    )
+    for text in tests:
+        assert bleach.is_clean(text), text
+
+
+def test_not_clean():
+    tests = (
+        '<script>safe()</script>',
+        'a <span>disallowed</span> tag',
+        'text</span>',
+        '<a href="http://example.com" onclick="evil()">link</a>',
+        '<a href="javascript:alert(1)">link</a>',
+        '<a href="jav&#x09;ascript:alert(1)">link</a>',
+        '<!-- comment -->',
+        '<b title="a" title="b">duplicate</b>',
+    )
+    for text in tests:
+        assert not bleach.is_clean(text), text
+
+
+def test_policy():
+    eq_(False, bleach.is_clean('<p>x</p>'))
+    eq_(True, bleach.is_clean('<p>x</p>', tags=['p']))
+    eq_(True, bleach.is_clean('<!-- c -->', strip_comments=False))
+    style = '<p style="color: red;">x</p>'
+    cleaner = bleach.Cleaner(tags=['p'], attributes=['style'],
+                             styles=['color'])
+    eq_(True, cleaner.is_clean(style))
+    eq_(False, cleaner.is_clean('<p style="color: red; top: 0;">x</p>'))
+    eq_(False, cleaner.is_clean('<p style="color:red">x</p>'))
+
+
+def test_content_states():
+    cleaner = bleach.Cleaner(tags=['textarea'])
+    eq_(True, cleaner.is_clean('<textarea><script>x</script></textarea>'))
+    eq_(False, cleaner.is_clean('<textarea></textarea><script></script>'))
+    eq_(False, bleach.is_clean('<textarea><b>x</b></textarea>'))
+
+
+def test_cleaned_is_clean():
+    cleaner = bleach.Cleaner(tags=['b', 'p', 'a', 'img', 'textarea'],
+                             attributes={'a': ['href'], '*': ['title']})
+    for text in fragments(500):
+        cleaned = cleaner.clean(text)
+        assert cleaner.is_clean(cleaned), cleaned
+        if cleaner.is_clean(text):
+            eq_(cleaned, cleaner.clean(cleaned))
+
+
+def test_limits():
+    cleaner = bleach.Cleaner(max_length=10, max_tokens=3)
+    eq_(True, cleaner.is_clean('<b>x</b>'))
+    assert_raises(bleach.LimitExceeded, cleaner.is_clean, 'x' * 11)
+    assert_raises(bleach.LimitExceeded, cleaner.is_clean, '<b>x</b>y')
+
+
+def test_no_linkify():
+    cleaner = bleach.Cleaner(linkify=True)
+    assert_raises(ValueError, cleaner.is_clean, 'example.com')
@@ -0,0 +1,73 @@
+from __future__ import unicode_literals
+import pickle
+
+from nose.tools import assert_raises, eq_
+
+import bleach
+
+
+def test_no_limits():
+    eq_('<b>' * 100 + 'x' + '</b>' * 100, bleach.clean('<b>' * 100 + 'x'))
+
+
+def test_max_length():
+    eq_('x' * 10, bleach.clean('x' * 10, max_length=10))
+    eq_('<b>x</b>', bleach.clean('<b>x</b>', max_length=8))
+    assert_raises(bleach.LimitExceeded, bleach.clean, 'x' * 11,
+                  max_length=10)
+    assert_raises(bleach.LimitExceeded, bleach.clean, '<b>x</b>!',
+                  max_length=8)
+    assert_raises(bleach.LimitExceeded, bleach.linkify, 'example.com',
+                  max_length=10)
+
+
+def test_max_depth():
+    eq_('<b><i>x</i></b>', bleach.clean('<b><i>x</i></b>', max_depth=2))
+    for dirty in ('<b><i>x</i></b>', '<b><i>', '<b>' * 100000):
+        assert_raises(bleach.LimitExceeded, bleach.clean, dirty,
+                      max_depth=1)
+    assert_raises(bleach.LimitExceeded, bleach.linkify,
+                  '<em>' * 100000 + 'example.com', max_depth=100)
+
+
+def test_max_depth_counts_tree():
+    # Disallowed tags are escaped and implicitly closed ones don't nest.
+    eq_('<b>&lt;span&gt;&lt;span&gt;x</b>',
+        bleach.clean('<b><span><span>x</b>', max_depth=1))
+    eq_('<p>a</p><p>b</p><p>c</p>',
+        bleach.clean('<p>a<p>b<p>c', tags=['p'], max_depth=1))
+
+
+def test_max_tokens():
+    eq_('<b>x</b>', bleach.clean('<b>x</b>', max_tokens=3))
+    assert_raises(bleach.LimitExceeded, bleach.clean, '<b>x</b>y',
+                  max_tokens=3)
+    # Stripped tags still count.
+    assert_raises(bleach.LimitExceeded, bleach.clean, '<x>' * 100000,
+                  strip=True, max_tokens=1000)
+    assert_raises(bleach.LimitExceeded, bleach.linkify, '<b>x</b>y',
+                  max_tokens=3)
+
+
+def test_cleaner():
+    cleaner = bleach.Cleaner(max_length=100, max_depth=2, max_tokens=10)
+    eq_('<b>x</b>', cleaner.clean('<b>x</b>'))
+    for dirty in ('x' * 101, '<b><i><em>', '<b></b>' * 6):
+        assert_raises(bleach.LimitExceeded, cleaner.clean, dirty)
+    assert_raises(bleach.LimitExceeded, list,
+                  cleaner.iter_clean(['<b></b>'] * 6))
+    # A failed fragment doesn't affect the next one.
+    eq_('<b>x</b>', cleaner.clean('<b>x</b>'))
+
+
+def test_cache():
+    cache = bleach.CleanCache()
+    bleach.clean('<b><i>x</i></b>', cache=cache)
+    assert_raises(bleach.LimitExceeded, bleach.clean, '<b><i>x</i></b>',
+                  max_depth=1, cache=cache)
+
+
+def test_pickle():
+    error = pickle.loads(pickle.dumps(bleach.LimitExceeded('too long')))
+    assert isinstance(error, ValueError)
+    eq_(('too long',), error.args)
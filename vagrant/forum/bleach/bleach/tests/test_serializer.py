@@ -0,0 +1,70 @@
+from __future__ import unicode_literals
+import random
+
+import html5lib
+from html5lib.serializer.htmlserializer import HTMLSerializer
+from nose.tools import eq_
+
+import bleach
+from bleach.serializer import serialize_etree
+
+
+PARSER = html5lib.HTMLParser()
+WALKER = html5lib.treewalkers.getTreeWalker('etree')
+SERIALIZER = HTMLSerializer(quote_attr_values=True,
+                            alphabetical_attributes=True,
+                            omit_optional_tags=False)
+
+PIECES = [
+    '<p>', '</p>', '<b class="x" id=\'y\' title="a\'b">', '</b>', '<em>',
+    '</em>', 'text & more', '<', '>', '"q"', "'", '<br>', '\n\t ',
+    '<img src=x ismap alt="a&amp;b">', '<style>a<b>&c</style>',
+    '<script>x<y</script>', '<textarea><i>t</i></textarea>',
+    '<!-- c -->', '<table><td>x</table>', '<math><mi>x</mi></math>',
+    '<input disabled checked=checked value=\'"v"\'>', '\xa0\xe9\u2603',
+    '<noscript><b>n</b></noscript>', '<iframe>i<b></iframe>',
+    '<a href="x" title="a&quot;b\'c">l</a>', '&lt;&gt;&amp;',
+]
+
+
+def fragments(count, seed=2016):
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield ''.join(rnd.choice(PIECES) for j in range(rnd.randint(1, 15)))
+
+
+def test_matches_html5lib():
+    for text in fragments(1000):
+        tree = PARSER.parseFragment(text)
+        eq_(SERIALIZER.render(WALKER(tree)), serialize_etree(tree))
+        for node in tree:
+            eq_(SERIALIZER.render(WALKER(node)), serialize_etree(node))
+
+
+def test_unsorted_attributes():
+    tree = PARSER.parseFragment('<b title="t" id="i" class="c">x</b>')
+    unsorted = serialize_etree(tree, sort_attributes=False)
+    eq_(serialize_etree(tree), serialize_etree(PARSER.parseFragment(unsorted)))
+
+
+def test_deep_tree():
+    text = '<em>' * 2000 + 'x' + '</em>' * 2000
+    eq_(text, serialize_etree(PARSER.parseFragment(text)))
+
+
+def test_cleaner():
+    cleaner = bleach.Cleaner()
+    fast = bleach.Cleaner(fast_serializer=True)
+    for text in fragments(200):
+        eq_(cleaner.clean(text), fast.clean(text))
+
+
+def test_cleaner_sort_attributes():
+    cleaner = bleach.Cleaner(tags=['b'], attributes=['title', 'id', 'class'],
+                             sort_attributes=False)
+    fast = bleach.Cleaner(tags=['b'], attributes=['title', 'id', 'class'],
+                          sort_attributes=False, fast_serializer=True)
+    dirty = '<b title="t" id="i" class="c">x</b>'
+    sort = bleach.Cleaner(tags=['b'], attributes=['title', 'id', 'class'])
+    for result in (cleaner.clean(dirty), fast.clean(dirty)):
+        eq_('<b class="c" id="i" title="t">x</b>', sort.clean(result))
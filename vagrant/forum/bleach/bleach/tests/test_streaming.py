@@ -0,0 +1,84 @@
+from __future__ import unicode_literals
+
+from nose.tools import assert_raises, eq_
+
+import bleach
+
+
+def split(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def stream(cleaner, chunks, **kwargs):
+    return ''.join(cleaner.iter_clean(chunks, **kwargs))
+
+
+def test_matches_clean():
+    cleaner = bleach.Cleaner(tags=['a', 'b', 'em', 'p', 'br', 'textarea'],
+                             attributes={'a': ['href'], 'b': ['style']},
+                             styles=['color'])
+    tests = (
+        'an <em>allowed</em> tag',
+        'a <em>fixed tag',
+        'a <script>safe()</script> test',
+        '<a href="http://xx.com" title="t">xx.com</a>',
+        '<a href="javascript:alert(1)">x</a>',
+        '<b style="color: red; top: 0">x</b>',
+        'tag < <em>and</em> &amp; entity &lt;&nbsp;',
+        '<!-- comment -->Just text',
+        'x</b>y<br/>z',
+        '<textarea><b>not a tag</b></textarea>',
+        'nul\x00 and\r\nnewline',
+    )
+
+    def check(text, size):
+        eq_(cleaner.clean(text), stream(cleaner, split(text, size)))
+
+    for text in tests:
+        for size in (1, 2, 5, len(text)):
+            yield check, text, size
+
+
+def test_strip():
+    cleaner = bleach.Cleaner(tags=['p'], strip=True)
+    s = '<p><span>multiply <span>nested <span>text</span></span></span></p>'
+    eq_('<p>multiply nested text</p>', stream(cleaner, split(s, 3)))
+
+
+def test_closes_open_tags():
+    cleaner = bleach.Cleaner()
+    eq_('<b><i>x</i></b>y', stream(cleaner, ['<b><i>x</b>y']))
+    eq_('<b>x</b>', stream(cleaner, ['<b>x']))
+
+
+def test_max_depth():
+    cleaner = bleach.Cleaner()
+    eq_('<b><b>x</b></b>y', stream(cleaner, ['<b>' * 5, 'x', '</b>' * 5, 'y'],
+                                   max_depth=2))
+
+
+def test_bytes_chunks():
+    cleaner = bleach.Cleaner()
+    eq_('caf\xe9 <b>x</b>', stream(cleaner, [b'caf\xc3', b'\xa9 <b>x']))
+
+
+def test_empty():
+    eq_([], list(bleach.Cleaner().iter_clean([])))
+
+
+def test_no_linkify():
+    cleaner = bleach.Cleaner(linkify=True)
+    assert_raises(ValueError, list, cleaner.iter_clean(['example.com']))
+
+
+def test_lazy():
+    consumed = []
+
+    def chunks():
+        for i in range(10000):
+            consumed.append(i)
+            yield '<em>chunk</em> '
+
+    output = bleach.Cleaner().iter_clean(chunks())
+    eq_('<em>chunk</em>', next(output)[:14])
+    assert len(consumed) < 10000
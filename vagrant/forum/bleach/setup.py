@@ -47,7 +47,7 @@ setup(
     license='Apache Software License',
     packages=find_packages(),
     include_package_data=True,
-    package_data={'': ['README.rst']},
+    package_data={'': ['README.rst'], 'bleach': ['tlds.txt']},
     zip_safe=False,
     install_requires=install_requires,
     tests_require=[
@@ -4,10 +4,24 @@
 
 # The forumdb module is where the database interface code goes.
 import forumdb
+# The forummetrics module times requests for the /metrics page.
+import forummetrics
+# The bleach module sanitizes posts; forumdb.AddPost raises its errors.
+import bleach
 
 # Other modules used to run a web server.
+import argparse
 import cgi
-from wsgiref.simple_server import make_server
+import datetime
+import email.utils
+import errno
+import os
+import Queue
+import signal
+import threading
+import time
+import urllib
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 from wsgiref import util
 
 # HTML template for the forum page
@@ -32,40 +46,216 @@ HTML_WRAP = '''\
       <div><textarea id="content" name="content"></textarea></div>
       <div><button id="go" type="submit">Post message</button></div>
     </form>
+    <form method=get action="/search">
+      <div><input id="q" name="q"> <button type="submit">Search</button></div>
+    </form>
     <!-- post content will go here -->
 %s
   </body>
 </html>
 '''
 
-# HTML template for an individual comment
-POST = '''\
-    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+# The forum page split around the posts, so it can be sent in pieces
+HTML_HEAD, HTML_TAIL = (HTML_WRAP % '\0').split('\0')
+
+# HTML template for the link to the next page of posts
+OLDER = '''\
+    <div class=older><a href="/?before=%(before)s">older posts</a></div>
+'''
+
+# HTML templates for the search results page
+SEARCH_RESULTS = '''\
+    <h2>Posts matching &ldquo;%(q)s&rdquo;</h2>
+'''
+SEARCH_NONE = '''\
+    <p>No posts match &ldquo;%(q)s&rdquo;.</p>
 '''
+SEARCH_MORE = '''\
+    <div class=older>
+      <a href="/search?q=%(q)s&amp;after=%(after)s">more results</a></div>
+'''
+
+# Number of posts shown on each page
+POSTS_PER_PAGE = 20
+
+## Page cursors - a post's (time, id) written as "time,id" in the URL
+def EncodeCursor(cursor):
+    '''Turn a (time, id) cursor from forumdb.GetPosts into a URL value.'''
+    posted, post_id = cursor
+    return urllib.quote_plus('%s,%d' % (posted.isoformat(), post_id))
+
+def DecodeCursor(value):
+    '''Turn a URL value made by EncodeCursor back into a (time, id) cursor.
+
+    Returns None if the value is not a valid cursor.
+    '''
+    posted, sep, post_id = value.rpartition(',')
+    if not sep or not post_id.isdigit():
+        return None
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.datetime.strptime(posted, fmt), int(post_id)
+        except ValueError:
+            pass
+    return None
+
+## Search cursors - a match's (rank, id) written as "rank,id" in the URL
+def EncodeRankCursor(cursor):
+    '''Turn a (rank, id) cursor from forumdb.SearchPosts into a URL value.'''
+    return urllib.quote_plus('%r,%d' % cursor)
+
+def DecodeRankCursor(value):
+    '''Turn a URL value made by EncodeRankCursor back into a cursor.
+
+    Returns None if the value is not a valid cursor.
+    '''
+    rank, sep, post_id = value.rpartition(',')
+    if not sep or not post_id.isdigit():
+        return None
+    try:
+        return float(rank), int(post_id)
+    except ValueError:
+        return None
+
+## Conditional GET - has the client's copy of the page changed?
+def NotModified(env, etag, modified):
+    '''Return True if the request's validators match the current page.
+
+    Args:
+      env: The WSGI environment of the request.
+      etag: The current ETag of the page.
+      modified: When the page last changed, in seconds since the epoch, or
+        None if that is unknown.
+    '''
+    if 'HTTP_IF_NONE_MATCH' in env:
+        # If-None-Match takes precedence over If-Modified-Since.
+        tags = [t.strip() for t in env['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in tags or etag in tags or 'W/' + etag in tags
+    since = env.get('HTTP_IF_MODIFIED_SINCE')
+    if since and modified is not None:
+        since = email.utils.parsedate_tz(since)
+        if since is not None:
+            return modified <= email.utils.mktime_tz(since)
+    return False
+
+## Cache of the rendered front page
+class PageCache(object):
+    '''Holds one rendered page, tagged with the board version it shows.
+
+    get() returns the cached page while the board version is unchanged.
+    When it has changed, only one caller rebuilds the page; concurrent
+    callers wait for that rebuild instead of all querying the database.
+    '''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._version = None
+        self._page = None
+        self._building = False
+        self._stats = {'hits': 0, 'misses': 0, 'rebuilds': 0,
+                       'rebuild_time': 0.0}
+
+    def get(self, version, build):
+        '''Return the page for version, rendering it with build() if needed.'''
+        with self._cond:
+            while self._version != version and self._building:
+                self._cond.wait()
+            if self._version == version:
+                self._stats['hits'] += 1
+                return self._page
+            self._stats['misses'] += 1
+            self._building = True
+        start = time.time()
+        page = None
+        try:
+            page = build()
+        finally:
+            with self._cond:
+                self._building = False
+                if page is not None:
+                    self._version, self._page = version, page
+                    self._stats['rebuilds'] += 1
+                    self._stats['rebuild_time'] += time.time() - start
+                self._cond.notify_all()
+        return page
+
+    def stats(self):
+        '''Return a dictionary of hit, miss and rebuild-time counters.'''
+        with self._cond:
+            return dict(self._stats)
+
+# The front page, rebuilt only after forumdb.AddPost changes the board
+FRONT_PAGE = PageCache()
+
+## Generate the main page piece by piece
+def RenderView(before):
+    '''Yield the main page as it is produced: header, posts, then footer.
+
+    Posts are streamed from the database as they are rendered, so the
+    first bytes go out before the query finishes and memory use does not
+    depend on the page size.
+    '''
+    yield HTML_HEAD
+    last = None
+    # Ask for one post more than a page, to find out if there are more.
+    posts = forumdb.IterPosts(before, POSTS_PER_PAGE + 1)
+    try:
+        for count, (html, cursor) in enumerate(posts):
+            if count == POSTS_PER_PAGE:
+                yield OLDER % {'before': EncodeCursor(last)}
+                break
+            last = cursor
+            yield html
+    finally:
+        posts.close()
+    yield HTML_TAIL
+
+def RenderFrontPage():
+    '''Return the whole front page as one string.'''
+    with forummetrics.Timed('render'):
+        return ''.join(RenderView(None))
 
 ## Request handler for main page
 def View(env, resp):
     '''View is the 'main page' of the forum.
 
-    It displays the submission form and the previously posted messages.
+    It displays the submission form and one page of the previously posted
+    messages, with a link to the next page of older ones. The front page
+    comes from FRONT_PAGE; older pages are streamed out as they are read.
+    Requests whose If-None-Match or If-Modified-Since still match the board
+    get an empty 304 Not Modified response.
     '''
-    # get posts from database
-    posts = forumdb.GetAllPosts()
+    # find out which page was asked for
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    before = None
+    if 'before' in fields:
+        before = DecodeCursor(fields['before'][0])
+    # let clients skip the page if nothing was posted since they got it
+    max_id, modified = forumdb.GetBoardStamp()
+    headers = [('ETag', '"%d"' % max_id),
+               ('Cache-Control', 'no-cache')]
+    if modified is not None:
+        headers.append(('Last-Modified',
+                        email.utils.formatdate(modified, usegmt=True)))
+    if NotModified(env, '"%d"' % max_id, modified):
+        resp('304 Not Modified', headers)
+        return []
     # send results
-    headers = [('Content-type', 'text/html')]
+    headers.append(('Content-type', 'text/html'))
     resp('200 OK', headers)
-    #return [HTML_WRAP % ''.join(POST % p for p in posts)]
-
-    html_str = ''.join(POST % p for p in posts)
-
-    return [HTML_WRAP % html_str]
+    if before is None:
+        # max_id catches posts made by other server processes.
+        version = (max_id, forumdb.BoardVersion())
+        return [FRONT_PAGE.get(version, RenderFrontPage)]
+    return RenderView(before)
 
 ## Request handler for posting - inserts to database
 def Post(env, resp):
     '''Post handles a submission of the forum's form.
 
     The message the user posted is saved in the database, then it sends a 302
-    Redirect back to the main page so the user can see their new post.
+    Redirect back to the main page so the user can see their new post. A post
+    over forumdb's size or nesting limits gets a 413 instead.
     '''
     # Get post content
     input = env['wsgi.input']
@@ -79,16 +269,102 @@ def Post(env, resp):
         content = content.strip()
         if content:
             # Save it in the database
-            forumdb.AddPost(content)
+            try:
+                forumdb.AddPost(content)
+            except bleach.LimitExceeded as e:
+                resp('413 Request Entity Too Large',
+                     [('Content-type', 'text/plain')])
+                return ['Post not saved: %s\n' % e]
     # 302 redirect back to the main page
     headers = [('Location', '/'),
                ('Content-type', 'text/plain')]
     resp('302 REDIRECT', headers)
     return ['Redirecting']
 
+## Request handler for searching posts
+def Search(env, resp):
+    '''Search shows the posts matching the q query parameter, best first.
+
+    Each page links to the next one with an after cursor.
+    '''
+    fields = cgi.parse_qs(env.get('QUERY_STRING', ''))
+    q = fields.get('q', [''])[0].strip()
+    after = None
+    if 'after' in fields:
+        after = DecodeRankCursor(fields['after'][0])
+    posts, next_after = [], None
+    if q:
+        posts, next_after = forumdb.SearchPosts(q, after, POSTS_PER_PAGE)
+    headers = [('Content-type', 'text/html')]
+    resp('200 OK', headers)
+
+    with forummetrics.Timed('render'):
+        template = SEARCH_RESULTS if posts else SEARCH_NONE
+        html_str = template % {'q': cgi.escape(q, True)}
+        html_str += ''.join(p['html'] for p in posts)
+        if next_after is not None:
+            html_str += SEARCH_MORE % {'q': urllib.quote_plus(q),
+                                       'after': EncodeRankCursor(next_after)}
+        return [HTML_WRAP % html_str]
+
+## Request handler for monitoring
+def Metrics(env, resp):
+    '''Metrics reports request timings and server counters.
+
+    The output is in Prometheus text format. It covers this server process
+    only.
+    '''
+    pool = forumdb.PoolStats()
+    cache = FRONT_PAGE.stats()
+    clean = forumdb.CLEAN_CACHE.stats()
+    text = [forummetrics.Render(),
+            forummetrics.FormatValue(
+                'forum_db_pool_checkouts_total', 'counter',
+                'Connections checked out of the pool.', pool['checkouts']),
+            forummetrics.FormatValue(
+                'forum_db_pool_wait_seconds_total', 'counter',
+                'Time spent waiting to check out a connection.',
+                pool['wait_total']),
+            forummetrics.FormatValue(
+                'forum_db_pool_connections', 'gauge',
+                'Open database connections.', pool['size']),
+            forummetrics.FormatValue(
+                'forum_db_pool_idle_connections', 'gauge',
+                'Open database connections not checked out.', pool['idle']),
+            forummetrics.FormatValue(
+                'forum_front_page_hits_total', 'counter',
+                'Front page requests served from the cache.', cache['hits']),
+            forummetrics.FormatValue(
+                'forum_front_page_misses_total', 'counter',
+                'Front page requests that rebuilt the page.',
+                cache['misses']),
+            forummetrics.FormatValue(
+                'forum_front_page_rebuild_seconds_total', 'counter',
+                'Time spent rebuilding the front page.',
+                cache['rebuild_time']),
+            forummetrics.FormatValue(
+                'forum_clean_cache_hits_total', 'counter',
+                'Posts whose sanitized HTML came from the cache.',
+                clean['hits']),
+            forummetrics.FormatValue(
+                'forum_clean_cache_misses_total', 'counter',
+                'Posts that had to be sanitized.', clean['misses']),
+            forummetrics.FormatValue(
+                'forum_clean_cache_entries', 'gauge',
+                'Sanitized posts held in the cache.', clean['entries']),
+            forummetrics.FormatValue(
+                'forum_clean_cache_bytes', 'gauge',
+                'Memory used by sanitized posts in the cache.',
+                clean['bytes'])]
+    headers = [('Content-type', 'text/plain; version=0.0.4')]
+    resp('200 OK', headers)
+    return [''.join(text)]
+
 ## Dispatch table - maps URL prefixes to request handlers
 DISPATCH = {'': View,
             'post': Post,
+            'search': Search,
+            'metrics': Metrics,
 	    }
 
 ## Dispatcher forwards requests according to the DISPATCH table.
@@ -103,9 +379,185 @@ def Dispatcher(env, resp):
         resp(status, headers)
         return ['Not Found: ' + page]
 
+## Name of the handler a request goes to, for labelling its metrics.
+def Route(env):
+    '''Return the name of the DISPATCH handler for a request.'''
+    page = env.get('PATH_INFO', '').lstrip('/').split('/', 1)[0]
+    if page in DISPATCH:
+        return DISPATCH[page].__name__.lower()
+    return 'notfound'
 
-# Run this bad server only on localhost!
-httpd = make_server('', 8000, Dispatcher)
-print "Serving HTTP on port 8000..."
-httpd.serve_forever()
 
+## App factory - importing this module does not start a server
+def CreateApp(pool_min=None, pool_max=None, group_commit=0,
+              commit_delay=0.005, durable_posts=True):
+    '''Set up the database connection pool and return the WSGI app.
+
+    The app is the Dispatcher, wrapped to time requests for /metrics. Call
+    this in the process that will serve requests (after forking), so that
+    each process gets its own database connections. If group_commit
+    is more than 1, posts are written in batches of up to that many; see
+    forumdb.StartGroupCommit for commit_delay and durable_posts.
+    '''
+    forumdb.ConfigurePool(pool_min, pool_max)
+    if group_commit > 1:
+        forumdb.StartGroupCommit(group_commit, commit_delay, durable_posts)
+    return forummetrics.Instrument(Dispatcher, Route)
+
+## A WSGI server that handles requests on a fixed pool of threads
+class PooledWSGIServer(WSGIServer):
+    '''WSGIServer that hands accepted requests to a pool of worker threads.
+
+    The workers are started by serve_forever(), so the listening socket can
+    be created first and shared by forked processes. server_close() stops
+    accepting, lets the workers finish every request already accepted, and
+    waits for them to exit.
+    '''
+
+    def __init__(self, server_address, threads=8,
+                 handler=WSGIRequestHandler, bind_and_activate=True):
+        WSGIServer.__init__(self, server_address, handler, bind_and_activate)
+        self.threads = threads
+        # Bounded, so a busy process leaves connections in the listen queue
+        # for other processes to accept.
+        self._requests = Queue.Queue(threads)
+        self._workers = []
+
+    def serve_forever(self, poll_interval=0.5):
+        if not self._workers:
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        WSGIServer.serve_forever(self, poll_interval)
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            self.shutdown_request(request)
+
+    def server_close(self):
+        WSGIServer.server_close(self)
+        for worker in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+## Serve requests in this process until SIGTERM or SIGINT.
+def Serve(server, **options):
+    '''Run server in this process, shutting down gracefully on a signal.
+
+    The options are passed on to CreateApp.
+    '''
+    server.set_app(CreateApp(**options))
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, which this
+        # (main) thread is running, so it has to be called elsewhere.
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        forumdb.StopGroupCommit()
+        forumdb.GetPool().closeall()
+
+## Serve requests from several forked processes sharing one socket.
+def ServePrefork(server, processes, **options):
+    '''Fork processes that each Serve() the listening socket of server.
+
+    Children that die are replaced. On SIGTERM or SIGINT the children are
+    told to shut down gracefully, and this returns once they have exited.
+    '''
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                Serve(server, **options)
+                status = 0
+            finally:
+                os._exit(status)
+        return pid
+
+    children = set(spawn() for i in range(processes))
+    stopping = []
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        children.discard(pid)
+        if not stopping:
+            children.add(spawn())
+    server.server_close()
+
+def Main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the DB Forum server.')
+    parser.add_argument('--host', default='',
+                        help='address to listen on (default: all)')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--threads', type=int, default=8,
+                        help='request threads per process')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of server processes to fork')
+    parser.add_argument('--pool-min', type=int, default=None,
+                        help='database connections kept open per process')
+    parser.add_argument('--pool-max', type=int, default=None,
+                        help='database connections allowed per process '
+                             '(default: one per thread)')
+    parser.add_argument('--group-commit', type=int, default=0,
+                        metavar='BATCH',
+                        help='write posts in batches of up to BATCH per '
+                             'commit (default: commit each post alone)')
+    parser.add_argument('--commit-delay', type=float, default=5.0,
+                        metavar='MS',
+                        help='longest a batch waits for more posts')
+    parser.add_argument('--async-posts', action='store_true',
+                        help='with --group-commit, answer a post before it '
+                             'is committed')
+    args = parser.parse_args(argv)
+    if args.pool_max is None:
+        args.pool_max = args.threads
+    if args.pool_min is not None:
+        args.pool_min = min(args.pool_min, args.pool_max)
+
+    server = PooledWSGIServer((args.host, args.port), args.threads)
+    options = {'pool_min': args.pool_min, 'pool_max': args.pool_max,
+               'group_commit': args.group_commit,
+               'commit_delay': args.commit_delay / 1000.0,
+               'durable_posts': not args.async_posts}
+    print "Serving HTTP on port %d..." % args.port
+    if args.processes > 1:
+        ServePrefork(server, args.processes, **options)
+    else:
+        Serve(server, **options)
+
+
+# Run this bad server only on localhost!
+if __name__ == '__main__':
+    Main()
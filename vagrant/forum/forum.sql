@@ -1,5 +1,24 @@
-
 CREATE TABLE posts ( content TEXT,
                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                     id SERIAL );
+                     id SERIAL PRIMARY KEY,
+                     -- The post rendered as HTML when it was added.
+                     html TEXT,
+                     -- Words of the post, for forumdb.SearchPosts.
+                     search TSVECTOR GENERATED ALWAYS AS
+                       (to_tsvector('english', coalesce(content, ''))) STORED );
+
+-- Serves the newest-first keyset pages read by forumdb.GetPosts.
+CREATE INDEX posts_time_id_idx ON posts (time DESC, id DESC);
+
+-- Finds the posts matching a search.
+CREATE INDEX posts_search_idx ON posts USING GIN (search);
 
+-- To upgrade a database created from an older version of this file:
+--   ALTER TABLE posts ADD PRIMARY KEY (id);
+--   ALTER TABLE posts ADD COLUMN html TEXT;
+--   ALTER TABLE posts ADD COLUMN search TSVECTOR GENERATED ALWAYS AS
+--     (to_tsvector('english', coalesce(content, ''))) STORED;
+--   CREATE INDEX posts_time_id_idx ON posts (time DESC, id DESC);
+--   CREATE INDEX posts_search_idx ON posts USING GIN (search);
+-- Older posts with no html are rendered when they are read.
+-- Generated columns need PostgreSQL 12 or later.
@@ -2,46 +2,634 @@
 # Database access functions for the web forum.
 #
 
+import sys
 import time
+import threading
+import traceback
+import Queue
+from contextlib import contextmanager
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 
 import bleach
 
+import forummetrics
+
+## Connection settings
+DSN = "dbname=forum"
+
+## Rows fetched per round trip when streaming posts - see IterPosts()
+ITERSIZE = 100
+
+## Recently sanitized posts, so reposts and floods of the same text are
+## not cleaned again
+CLEAN_CACHE = bleach.CleanCache(max_entries=10000,
+                                max_bytes=32 * 1024 * 1024)
+
+## Limits on post content, so one hostile post can't tie up a thread -
+## AddPost raises bleach.LimitExceeded for posts over them
+MAX_POST_LENGTH = 64 * 1024
+MAX_POST_DEPTH = 100
+MAX_POST_TOKENS = 20000
+
+## Sanitizer for post content, set up once and shared by every thread
+CLEANER = bleach.Cleaner(fast_serializer=True, cache=CLEAN_CACHE,
+                         max_length=MAX_POST_LENGTH,
+                         max_depth=MAX_POST_DEPTH,
+                         max_tokens=MAX_POST_TOKENS)
+
+## HTML fragment stored with each post, rendered once when it is added
+POST_HTML = '''\
+    <div class=post><em class=date>%(time)s</em><br>%(content)s</div>
+'''
+
+## Pool sizing - see ConfigurePool()
+POOL_MIN = 1
+POOL_MAX = 10
+# Seconds a connection may sit idle before it is pinged on checkout.
+POOL_PING_AFTER = 30.0
+
+## Pool of open database connections, shared across requests.
+class ConnectionPool(object):
+    '''A thread-safe pool of psycopg2 connections.
+
+    Connections are opened lazily up to maxconn. When every connection is
+    checked out, getconn() blocks until one is returned (or timeout seconds
+    pass). Connections are health-checked on checkout, and the time callers
+    spend waiting for a connection is recorded so the pool can be sized.
+    '''
+
+    def __init__(self, dsn, minconn=1, maxconn=10, ping_after=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('need 0 <= minconn <= maxconn and maxconn >= 1')
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.ping_after = ping_after
+        self._idle = []      # list of (connection, time it was returned)
+        self._size = 0       # connections currently open, idle or not
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        self._stats = {'checkouts': 0, 'waits': 0, 'wait_total': 0.0,
+                       'wait_max': 0.0, 'opened': 0, 'discarded': 0}
+        for i in range(minconn):
+            self._idle.append((self._connect(), time.time()))
+            self._size += 1
+            self._stats['opened'] += 1
+
+    def _connect(self):
+        return psycopg2.connect(self.dsn)
+
+    def _healthy(self, conn, idle_since):
+        '''Return True if conn can be handed out again.'''
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        try:
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # Somebody returned a connection mid-transaction.
+                conn.rollback()
+            if time.time() - idle_since >= self.ping_after:
+                c = conn.cursor()
+                c.execute('select 1;')
+                c.close()
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        '''Check a connection out of the pool.
+
+        Args:
+          timeout: Seconds to wait for a free connection, or None to wait
+            forever.
+
+        Raises:
+          psycopg2.pool.PoolError if the pool is closed or timeout expires.
+        '''
+        start = time.time()
+        waited = False
+        while True:
+            with self._cond:
+                conn = None
+                while True:
+                    if self._closed:
+                        raise psycopg2.pool.PoolError(
+                            'connection pool is closed')
+                    if self._idle:
+                        conn, idle_since = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        # Reserve the slot before releasing the lock.
+                        self._size += 1
+                        break
+                    remaining = None
+                    if timeout is not None:
+                        remaining = timeout - (time.time() - start)
+                        if remaining <= 0:
+                            raise psycopg2.pool.PoolError(
+                                'timed out waiting for a connection')
+                    waited = True
+                    self._cond.wait(remaining)
+            # Health checks and new connections talk to the server, so they
+            # happen without holding the pool lock.
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats['opened'] += 1
+                    self._checked_out(start, waited)
+                return conn
+            if self._healthy(conn, idle_since):
+                with self._cond:
+                    self._checked_out(start, waited)
+                return conn
+            with self._cond:
+                self._size -= 1
+                self._discard(conn)
+                self._cond.notify()
+
+    def _checked_out(self, start, waited):
+        wait = time.time() - start
+        stats = self._stats
+        stats['checkouts'] += 1
+        if waited:
+            stats['waits'] += 1
+        stats['wait_total'] += wait
+        if wait > stats['wait_max']:
+            stats['wait_max'] = wait
+
+    def putconn(self, conn, close=False):
+        '''Return a connection to the pool.
+
+        Args:
+          conn: A connection obtained from getconn().
+          close: If True, close the connection instead of keeping it.
+        '''
+        with self._cond:
+            if close or self._closed or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def closeall(self):
+        '''Close every idle connection and refuse further checkouts.'''
+        with self._cond:
+            self._closed = True
+            for conn, idle_since in self._idle:
+                self._size -= 1
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        '''Return a dictionary of pool counters.
+
+        Returns:
+          A dictionary with the number of checkouts, how many of them had
+          to wait, total and maximum checkout wait in seconds, the average
+          wait, and the current pool size and idle count.
+        '''
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+        stats['wait_avg'] = (stats['wait_total'] / stats['checkouts']
+                             if stats['checkouts'] else 0.0)
+        return stats
+
+
+## The shared pool, created on first use.
+_pool = None
+_pool_lock = threading.RLock()
+
+## Configure the shared connection pool.
+def ConfigurePool(minconn=None, maxconn=None, dsn=None, ping_after=None):
+    '''(Re)create the shared connection pool.
+
+    Any existing pool is closed. Arguments left as None fall back to the
+    module-level DSN, POOL_MIN, POOL_MAX and POOL_PING_AFTER settings.
+    '''
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = ConnectionPool(dsn or DSN,
+                               POOL_MIN if minconn is None else minconn,
+                               POOL_MAX if maxconn is None else maxconn,
+                               POOL_PING_AFTER if ping_after is None
+                               else ping_after)
+    return _pool
+
+def GetPool():
+    '''Return the shared connection pool, creating it if needed.'''
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                return ConfigurePool()
+    return _pool
+
+## Borrow a pooled connection for the duration of a with block.
+@contextmanager
+def Connection():
+    '''Check out a pooled connection, and return it to the pool afterwards.
+
+    If the block does not finish normally (it raises, or a generator using
+    the connection is closed early), the connection's transaction is rolled
+    back; a connection that is broken is closed rather than reused.
+    '''
+    pool = GetPool()
+    DB = pool.getconn()
+    finished = False
+    try:
+        yield DB
+        finished = True
+    finally:
+        broken = DB.closed
+        if not finished and not broken:
+            try:
+                DB.rollback()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(DB, close=broken)
+
+## Pool statistics, for sizing the pool.
+def PoolStats():
+    '''Return the shared pool's counters; see ConnectionPool.stats().'''
+    return GetPool().stats()
+
+## Board version, bumped by every write to the posts table.
+_version = 0
+_version_lock = threading.Lock()
+
+def BoardVersion():
+    '''Return a counter that changes whenever a post is added.
+
+    Anything rendered from the posts table while BoardVersion() returned v
+    is up to date for as long as BoardVersion() still returns v.
+    '''
+    return _version
+
+def _BumpVersion():
+    global _version
+    with _version_lock:
+        _version += 1
+
+## Get a cheap stamp of the posts table's state.
+def GetBoardStamp():
+    '''Get the newest post's id and the time of the latest post.
+
+    Both come straight from the ends of the posts indexes, so this is cheap
+    enough to run on every request to tell clients whether anything changed.
+
+    Returns:
+      A (max_id, modified) tuple, where max_id is the highest post id (0 if
+      there are no posts) and modified is the time of the latest post in
+      seconds since the epoch (None if there are no posts).
+    '''
+    with Connection() as DB:
+        c = DB.cursor()
+        with forummetrics.Timed('db'):
+            c.execute('select max(id), '
+                      'extract(epoch from max(time)::timestamptz) from posts;')
+            max_id, modified = c.fetchone()
+        DB.rollback()
+    if modified is not None:
+        modified = int(modified)
+    return max_id or 0, modified
+
 ## Get posts from database.
 def GetAllPosts():
     '''Get all the posts from the database, sorted with the newest first.
 
     Returns:
       A list of dictionaries, where each dictionary has a 'content' key
-      pointing to the post content, and 'time' key pointing to the time
-      it was posted.
+      pointing to the post content, a 'time' key pointing to the time
+      it was posted, and an 'html' key pointing to the rendered post.
     '''
-
-    ## Database connection
-    DB = psycopg2.connect("dbname=forum")
-    c = DB.cursor()
-    query = 'select * from posts order by time desc;'
-    c.execute(query)
-    posts = c.fetchall()
+    with Connection() as DB:
+        c = DB.cursor()
+        query = ('select content, time, id, html from posts '
+                 'order by time desc;')
+        with forummetrics.Timed('db'):
+            c.execute(query)
+            posts = c.fetchall()
+        # End the read-only transaction before handing the connection back.
+        DB.rollback()
     # formatting
-    posts = [{'content': str(post[0]),'time': str(post[1])} for post in posts]
-    DB.close()
-    print ' ****** forumdb posts ****** '
-    print posts
+    posts = [_PostDict(post) for post in posts]
 
     return posts
 
+## Render the HTML fragment for a post.
+def RenderPost(content, time):
+    '''Return the HTML fragment for a post, as stored in posts.html.
+
+    Args:
+      content: The post content, already sanitized.
+      time: The time it was posted.
+    '''
+    return POST_HTML % {'content': content, 'time': str(time)}
+
+def _PostDict(row):
+    '''Turn a (content, time, id, html) row into a post dictionary.'''
+    html = row[3]
+    if html is None:
+        # Posts added before posts.html existed.
+        html = RenderPost(row[0], row[1])
+    return {'content': str(row[0]), 'time': str(row[1]), 'html': html}
+
+## SQL for reading posts newest first, starting after a keyset cursor.
+def _PostsQuery(before, limit):
+    query = 'select content, time, id, html from posts'
+    args = ()
+    if before is not None:
+        query += ' where (time, id) < (%s, %s)'
+        args += tuple(before)
+    query += ' order by time desc, id desc'
+    if limit is not None:
+        query += ' limit %s'
+        args += (limit,)
+    return query + ';', args
+
+## Get one page of posts from database.
+def GetPosts(before=None, limit=20):
+    '''Get a page of posts from the database, sorted with the newest first.
+
+    Pages are addressed with keyset cursors, so fetching any page is a
+    single index range scan on posts(time, id) no matter how deep it is.
+
+    Args:
+      before: None for the newest page, or the (time, id) cursor returned
+        with the previous page to get the posts older than it.
+      limit: The maximum number of posts to return.
+
+    Returns:
+      A (posts, next_before) tuple. posts is a list of dictionaries like
+      the ones GetAllPosts returns; next_before is the cursor to pass as
+      before to get the next page of older posts, or None if this is the
+      last page.
+    '''
+    # Fetch one extra row to find out if there is another page.
+    query, args = _PostsQuery(before, limit + 1)
+    with Connection() as DB:
+        c = DB.cursor()
+        with forummetrics.Timed('db'):
+            c.execute(query, args)
+            rows = c.fetchall()
+        DB.rollback()
+    next_before = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_before = (rows[-1][1], rows[-1][2])
+    posts = [_PostDict(row) for row in rows]
+    return posts, next_before
+
+## Search posts.
+def SearchPosts(query, after=None, limit=20):
+    '''Get a page of the posts matching a full-text search, best first.
+
+    Matches are found with the GIN index on posts.search and ranked with
+    ts_rank; pages are addressed with (rank, id) keyset cursors.
+
+    Args:
+      query: The search, in web search syntax ("quoted phrases", or, -not).
+      after: None for the best matches, or the (rank, id) cursor returned
+        with the previous page to get the matches after it.
+      limit: The maximum number of posts to return.
+
+    Returns:
+      A (posts, next_after) tuple. posts is a list of dictionaries like
+      the ones GetAllPosts returns; next_after is the cursor to pass as
+      after to get the next page, or None if this is the last page.
+    '''
+    sql = ('select content, time, id, html, rank from ('
+           ' select content, time, id, html, ts_rank(search, q) as rank'
+           ' from posts, websearch_to_tsquery(\'english\', %s) q'
+           ' where search @@ q) matches')
+    args = (query,)
+    if after is not None:
+        sql += ' where (rank, id) < (%s::real, %s)'
+        args += tuple(after)
+    sql += ' order by rank desc, id desc limit %s;'
+    # Fetch one extra row to find out if there is another page.
+    args += (limit + 1,)
+    with Connection() as DB:
+        c = DB.cursor()
+        with forummetrics.Timed('db'):
+            c.execute(sql, args)
+            rows = c.fetchall()
+        DB.rollback()
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = (rows[-1][4], rows[-1][2])
+    posts = [_PostDict(row) for row in rows]
+    return posts, next_after
+
+## Stream posts from database.
+def IterPosts(before=None, limit=None, itersize=None):
+    '''Iterate over posts, newest first, without loading them all at once.
+
+    The posts are read through a server-side (named) cursor, which fetches
+    itersize rows per round trip, so memory use stays bounded however many
+    posts there are. A pooled connection is held until the iterator is
+    exhausted or closed. Each post's HTML was rendered when it was added,
+    so rows are passed on without any formatting.
+
+    Args:
+      before: None to start at the newest post, or a (time, id) cursor to
+        start just after.
+      limit: The maximum number of posts to yield, or None for all of them.
+      itersize: Rows per round trip; defaults to ITERSIZE.
+
+    Yields:
+      (html, cursor) tuples, holding the post's rendered HTML and its
+      (time, id) cursor.
+    '''
+    query, args = _PostsQuery(before, limit)
+    with Connection() as DB:
+        c = DB.cursor('forumdb_posts')
+        c.itersize = itersize or ITERSIZE
+        with forummetrics.Timed('db'):
+            c.execute(query, args)
+        while True:
+            # Fetch explicitly (rather than iterate over c) so only the
+            # round trips are timed, not the time spent between yields.
+            with forummetrics.Timed('db'):
+                rows = c.fetchmany(c.itersize)
+            if not rows:
+                break
+            for content, posted, post_id, html in rows:
+                if html is None:
+                    html = RenderPost(content, posted)
+                yield html, (posted, post_id)
+        c.close()
+        DB.rollback()
+
+## Write posts to the database.
+def _InsertPosts(DB, contents):
+    '''Insert sanitized posts with one multi-row INSERT, and commit.'''
+    c = DB.cursor()
+    with forummetrics.Timed('db'):
+        # Use the same timestamp the time column would default to, so the
+        # rendered posts can be stored along with it.
+        c.execute("SELECT LOCALTIMESTAMP;")
+        posted = c.fetchone()[0]
+        rows = ','.join(c.mogrify("(%s, %s, %s)",
+                                  (content, posted,
+                                   RenderPost(content, posted)))
+                        for content in contents)
+        c.execute("INSERT INTO posts (content, time, html) VALUES " + rows)
+        DB.commit()
+
+## Group commit - batch concurrent posts into one transaction.
+class _PendingPost(object):
+    '''A post waiting in the group commit queue.'''
+
+    def __init__(self, content):
+        self.content = content
+        self.done = threading.Event()
+        self.error = None
+
+class GroupCommitWriter(object):
+    '''Writes queued posts in batches, one INSERT and one commit per batch.
+
+    A background thread takes the first waiting post, then collects more
+    until it has batch_size posts or max_delay seconds have passed, and
+    writes them all in one transaction. If the batch fails, its posts are
+    retried one by one so a single bad post cannot lose the others.
+
+    If durable is True, callers are expected to wait on each post; if not,
+    nobody waits, so posts that fail to be written are reported on stderr.
+    '''
+
+    def __init__(self, batch_size=50, max_delay=0.005, durable=True):
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.durable = durable
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add(self, content):
+        '''Queue sanitized content; returns a _PendingPost to wait on.'''
+        pending = _PendingPost(content)
+        self._queue.put(pending)
+        return pending
+
+    def close(self):
+        '''Write every queued post, then stop the writer thread.'''
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if pending is None:
+                    stopping = True
+                    break
+                batch.append(pending)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with Connection() as DB:
+                _InsertPosts(DB, [pending.content for pending in batch])
+        except Exception:
+            if len(batch) == 1:
+                batch[0].error = sys.exc_info()
+                if not self.durable:
+                    traceback.print_exc()
+            else:
+                for pending in batch:
+                    self._write([pending])
+                return
+        else:
+            _BumpVersion()
+        for pending in batch:
+            pending.done.set()
+
+## The group commit writer, if group commit is on.
+_writer = None
+
+def StartGroupCommit(batch_size=50, max_delay=0.005, durable=True):
+    '''Make AddPost queue posts for a GroupCommitWriter.
+
+    Args:
+      batch_size: The most posts written in one transaction.
+      max_delay: The longest, in seconds, a batch waits for more posts.
+      durable: If True, AddPost returns only once its post is committed
+        (and raises if that failed). If False, it returns once the post is
+        queued, and failed writes are only reported on stderr.
+    '''
+    global _writer
+    StopGroupCommit()
+    _writer = GroupCommitWriter(batch_size, max_delay, durable)
+
+def StopGroupCommit():
+    '''Write any queued posts and go back to committing each post alone.'''
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
 ## Add a post to the database.
 def AddPost(content):
     '''Add a new post to the database.
 
+    With group commit on (see StartGroupCommit), the post is written as
+    part of a batch.
+
     Args:
       content: The text content of the new post.
+
+    Raises bleach.LimitExceeded, without saving the post, if the content
+    is over the MAX_POST_* limits.
     '''
-    ## Database connection
-    DB = psycopg2.connect("dbname=forum")
-    c = DB.cursor()
-    sanit_content = str(bleach.clean(content))
-    c.execute("INSERT INTO posts (content) VALUES (%s)", (sanit_content,))
-    DB.commit()
-    DB.close()
+    with forummetrics.Timed('sanitize'):
+        sanit_content = str(CLEANER.clean(content))
+    writer = _writer
+    if writer is None:
+        with Connection() as DB:
+            _InsertPosts(DB, [sanit_content])
+        _BumpVersion()
+        return
+    pending = writer.add(sanit_content)
+    if writer.durable:
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error[0], pending.error[1], pending.error[2]
@@ -0,0 +1,182 @@
+#
+# Request timing for the web forum, exported in Prometheus text format.
+#
+
+import threading
+import time
+from contextlib import contextmanager
+
+## Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+## A latency histogram, with one set of buckets per label combination.
+class Histogram(object):
+    '''A thread-safe Prometheus histogram.
+
+    Args:
+      name: The metric name.
+      help: A one-line description of the metric.
+      labels: The names of the labels every observation is made with.
+      buckets: Increasing bucket upper bounds; +Inf is added.
+    '''
+
+    def __init__(self, name, help, labels, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # label values -> [bucket counts, sum, count]
+
+    def observe(self, values, seconds):
+        '''Record one observation for the label values given as a tuple.'''
+        with self._lock:
+            series = self._series.get(values)
+            if series is None:
+                series = self._series[values] = [[0] * len(self.buckets),
+                                                 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        '''Return the histogram in Prometheus text format.'''
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s histogram' % self.name]
+        with self._lock:
+            series = sorted((values, (list(s[0]), s[1], s[2]))
+                            for values, s in self._series.items())
+        for values, (counts, total, count) in series:
+            labels = ','.join('%s="%s"' % (label, _Escape(value))
+                              for label, value in zip(self.labels, values))
+            sep = ',' if labels else ''
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket{%s%sle="%r"} %d'
+                             % (self.name, labels, sep, bound, cumulative))
+            lines.append('%s_bucket{%s%sle="+Inf"} %d'
+                         % (self.name, labels, sep, count))
+            lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return '\n'.join(lines) + '\n'
+
+def _Escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+## Format a single counter or gauge in Prometheus text format.
+def FormatValue(name, type, help, value):
+    '''Return one counter or gauge sample in Prometheus text format.'''
+    return '# HELP %s %s\n# TYPE %s %s\n%s %r\n' % (name, help, name, type,
+                                                   name, value)
+
+## The forum's histograms.
+REQUEST_SECONDS = Histogram(
+    'forum_request_seconds',
+    'Time taken to handle a request, including sending the body, by route.',
+    ['route'])
+PHASE_SECONDS = Histogram(
+    'forum_phase_seconds',
+    'Time each request spent in the db, sanitize and render phases.',
+    ['route', 'phase'])
+
+## Per-thread state of the request being timed.
+_local = threading.local()
+
+## Time a phase of the current request.
+@contextmanager
+def Timed(phase):
+    '''Add the time spent in the with block to phase for this request.
+
+    Phases nest: time spent in an inner phase is not also counted in the
+    outer one. Outside of a request (in a background thread, say), the
+    time is recorded under the route "background".
+    '''
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    now = time.time()
+    if stack:
+        _Charge(stack[-1][0], now - stack[-1][1])
+    stack.append([phase, now])
+    try:
+        yield
+    finally:
+        now = time.time()
+        phase, start = stack.pop()
+        _Charge(phase, now - start)
+        if stack:
+            stack[-1][1] = now
+
+def _Charge(phase, seconds):
+    phases = getattr(_local, 'phases', None)
+    if phases is None:
+        PHASE_SECONDS.observe(('background', phase), seconds)
+    else:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+## WSGI middleware timing every request.
+def Instrument(app, route_of):
+    '''Wrap a WSGI app so each request's latency and phases are recorded.
+
+    Args:
+      app: The WSGI application to time.
+      route_of: A function from the WSGI environment to a route name, used
+        to label the request's metrics.
+
+    A request is timed until its body has been sent and closed, so
+    streamed responses are measured in full.
+    '''
+    def instrumented(env, resp):
+        request = _Request(route_of(env))
+        try:
+            body = app(env, resp)
+        except Exception:
+            request.finish()
+            raise
+        return _TimedBody(body, request)
+    return instrumented
+
+class _Request(object):
+    '''Timing state for one request, attached to the serving thread.'''
+
+    def __init__(self, route):
+        self.route = route
+        self.start = time.time()
+        self.phases = _local.phases = {}
+        _local.stack = []
+
+    def finish(self):
+        REQUEST_SECONDS.observe((self.route,), time.time() - self.start)
+        for phase, seconds in self.phases.items():
+            PHASE_SECONDS.observe((self.route, phase), seconds)
+        if getattr(_local, 'phases', None) is self.phases:
+            _local.phases = None
+
+class _TimedBody(object):
+    '''A WSGI response body that finishes its request's timing on close.'''
+
+    def __init__(self, body, request):
+        self.body = body
+        self.request = request
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.request.finish()
+
+## All of the forum's histograms, in Prometheus text format.
+def Render():
+    '''Return every histogram in Prometheus text format.'''
+    return REQUEST_SECONDS.render() + PHASE_SECONDS.render()